@@ -5,25 +5,18 @@ class FirstTask(zmqpipeline.Task):
     task_type = zmqpipeline.TaskType(settings.TASK_TYPE_FIRST)
     endpoint = zmqpipeline.EndpointAddress(settings.FIRST_WORKER_ENDPOINT)
     dependencies = []
-    n_count = 0
 
-    def handle(self, data, address, msgtype):
+    def items(self):
         """
-        Simulates some work to be done
-        :param data:
-        :param address:
-        :param msgtype:
+        Simulates some work to be done. Items are pulled lazily by the distributor and the task
+        is marked complete once all of them have been ACKed.
         :return:
         """
-        self.n_count += 1
-        if self.n_count >= 500:
-            # mark as complete after 1000 executions. Should take a total of 10 seconds to run sequentially
-            self.is_complete = True
-
-        # return the work to be done on the worker
-        return {
-            'workload': .01
-        }
+        for _ in xrange(500):
+            # return the work to be done on the worker
+            yield {
+                'workload': .01
+            }
 
 
 class SecondTask(zmqpipeline.Task):
@@ -32,12 +25,13 @@ class SecondTask(zmqpipeline.Task):
     dependencies = [zmqpipeline.TaskType(settings.TASK_TYPE_FIRST)]
     n_count = 0
 
-    def handle(self, data, address, msgtype):
+    def handle(self, data, address, msgtype, ack_data={}):
         """
         Simulates some work to be done
         :param data:
         :param address:
         :param msgtype:
+        :param ack_data:
         :return:
         """
         self.n_count += 1
@@ -11,7 +11,7 @@ class TestTask(Task):
     endpoint = EndpointAddress(ENDPOINT_ADDRESS)
     dependencies = []
 
-    def handle(self, data, address, msgtype):
+    def handle(self, data, address, msgtype, ack_data={}):
         return data
 
 
@@ -19,3 +19,22 @@ class TaskFactory(common.FlexibleObjectFactory):
     class Meta:
         model = TestTask
 
+
+
+TASK_TYPE_STREAMING_TASK = 'STREAMINGTASK'
+TaskType.register_type(TASK_TYPE_STREAMING_TASK)
+N_STREAMING_ITEMS = 5
+
+class TestStreamingTask(Task):
+    task_type = TaskType(TASK_TYPE_STREAMING_TASK)
+    endpoint = EndpointAddress(ENDPOINT_ADDRESS)
+    dependencies = []
+
+    def items(self):
+        for i in xrange(N_STREAMING_ITEMS):
+            yield {'index': i}
+
+
+class StreamingTaskFactory(common.FlexibleObjectFactory):
+    class Meta:
+        model = TestStreamingTask
@@ -1,6 +1,6 @@
 import common
-from zmqpipeline import MetaDataWorker, SingleThreadedWorker, MultiThreadedWorker,\
-    EndpointAddress, TaskType
+from zmqpipeline import MetaDataWorker, SingleThreadedWorker, MultiThreadedWorker, MultiProcessWorker,\
+    GreenWorker, EndpointAddress, TaskType
 
 META_WORKER_ENDPOINT = 'tcp://localhost:5550'
 COLLECTOR_ENDPOINT = 'tcp://localhost:5551'
@@ -8,9 +8,13 @@ WORKER_ENDPOINT = 'tcp://localhost:5553'
 
 TASK_TYPE_ST = 'ST'
 TASK_TYPE_MT = 'MT'
+TASK_TYPE_MP = 'MP'
+TASK_TYPE_GR = 'GR'
 
 TaskType.register_type(TASK_TYPE_ST)
 TaskType.register_type(TASK_TYPE_MT)
+TaskType.register_type(TASK_TYPE_MP)
+TaskType.register_type(TASK_TYPE_GR)
 
 
 class TestMetaDataWorker(MetaDataWorker):
@@ -45,6 +49,15 @@ class SingleThreadedWorkerFactory(common.FlexibleObjectFactory):
         model = TestSingleThreadedWorker
 
 
+class TestCreditWorker(TestSingleThreadedWorker):
+    credit_window = 4
+
+
+class CreditWorkerFactory(common.FlexibleObjectFactory):
+    class Meta:
+        model = TestCreditWorker
+
+
 
 
 class TestMultiThreadWorker(MultiThreadedWorker):
@@ -67,3 +80,42 @@ class MultiThreadedWorkerFactory(common.FlexibleObjectFactory):
         model = TestMultiThreadWorker
 
 
+
+
+
+class TestMultiProcessWorker(MultiProcessWorker):
+    task_type = TaskType(TASK_TYPE_MP)
+
+    endpoint = EndpointAddress(WORKER_ENDPOINT)
+    collector_endpoint = EndpointAddress(COLLECTOR_ENDPOINT)
+
+    n_processes = 1
+
+    def handle_execution(self, data, *args, **kwargs):
+        return data
+
+    def handle_thread_execution(self, data, index):
+        return {'square': data['x'] ** 2}
+
+
+class MultiProcessWorkerFactory(common.FlexibleObjectFactory):
+    class Meta:
+        model = TestMultiProcessWorker
+
+
+
+class TestGreenWorker(GreenWorker):
+    task_type = TaskType(TASK_TYPE_GR)
+
+    endpoint = EndpointAddress(WORKER_ENDPOINT)
+    collector_endpoint = EndpointAddress(COLLECTOR_ENDPOINT)
+
+    max_concurrency = 50
+
+    def handle_execution(self, data, *args, **kwargs):
+        return data
+
+
+class GreenWorkerFactory(common.FlexibleObjectFactory):
+    class Meta:
+        model = TestGreenWorker
@@ -0,0 +1,41 @@
+from zmqpipeline.ack_history import AckHistory
+import pytest
+
+
+def ack(ack_id, task_type):
+    return {'_id': ack_id, '_task_type': task_type}
+
+
+def test_index():
+    history = AckHistory()
+    history.add(ack(1, 'A'))
+    history.add(ack(2, 'B'))
+    history.add(ack(3, 'A'))
+    assert len(history) == 3
+    assert 2 in history
+    assert history.get(2) == ack(2, 'B')
+    assert history.latest() == ack(3, 'A')
+    assert history.latest('B') == ack(2, 'B')
+    assert history.for_task('A') == [ack(1, 'A'), ack(3, 'A')]
+
+
+def test_bounded():
+    history = AckHistory(max_size = 2)
+    for i in range(1, 4):
+        history.add(ack(i, 'A'))
+    assert len(history) == 2
+    assert 1 not in history
+    assert history.get(1) is None
+    assert history.for_task('A') == [ack(2, 'A'), ack(3, 'A')]
+
+
+def test_empty():
+    history = AckHistory()
+    assert history.latest() == {}
+    assert history.latest('A') == {}
+    assert history.for_task('A') == []
+
+
+def test_invalid_size():
+    with pytest.raises(ValueError):
+        AckHistory(max_size = 0)
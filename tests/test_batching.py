@@ -0,0 +1,44 @@
+from zmqpipeline.batching import BatchSizer
+import pytest
+
+
+def test_default():
+    sizer = BatchSizer(100, target_message_rate = 10, latency_budget = 1.0)
+    assert sizer.batch_size(5) == 5
+
+
+def test_small_items_amortized():
+    sizer = BatchSizer(100, target_message_rate = 10, latency_budget = 1.0)
+    sizer.observe(0.2, 20)
+    # 10ms per item - 10 items per message keeps a worker at 10 messages per second
+    assert sizer.batch_size() == 10
+
+
+def test_latency_budget():
+    sizer = BatchSizer(100, target_message_rate = 10, latency_budget = 0.05)
+    sizer.observe(0.2, 20)
+    assert sizer.batch_size() == 5
+
+
+def test_big_items():
+    sizer = BatchSizer(100, target_message_rate = 10, latency_budget = 1.0)
+    sizer.observe(2.0, 1)
+    assert sizer.batch_size() == 1
+
+
+def test_max_batch_size():
+    sizer = BatchSizer(8, target_message_rate = 10, latency_budget = 1.0)
+    sizer.observe(0.001, 10)
+    assert sizer.batch_size() == 8
+
+
+def test_smoothing():
+    sizer = BatchSizer(100, target_message_rate = 10, latency_budget = 1.0, smoothing = 0.5)
+    sizer.observe(0.1, 10)
+    sizer.observe(0.3, 10)
+    assert sizer.item_time == pytest.approx(0.02)
+
+
+def test_invalid():
+    with pytest.raises(ValueError):
+        BatchSizer(0, target_message_rate = 10, latency_budget = 1.0)
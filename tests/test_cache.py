@@ -0,0 +1,57 @@
+from zmqpipeline.cache import ResultCache, cache_key
+import pytest
+
+
+def test_cache_key():
+    a = {'x': 1, 'y': {'b': [1, 2], 'a': 'z'}}
+    b = {'y': {'a': 'z', 'b': [1, 2]}, 'x': 1}
+    assert cache_key(a) == cache_key(b)
+    assert cache_key(a) == cache_key(dict(a, _item_id = 5, _shard = 1))
+    assert cache_key(a) == cache_key(dict(a, _dependency_item_id = 3, _deadline = 1500000000.0))
+    assert cache_key(a) != cache_key({'x': 2, 'y': {'b': [1, 2], 'a': 'z'}})
+    # a dictionary and a list of its pairs are different items
+    assert cache_key({'y': {'a': 1}}) != cache_key({'y': [['a', 1]]})
+    assert cache_key({'y': {'a': 1}}) != cache_key({'y': ['__dict__', [['a', 1]]]})
+
+
+def test_lru():
+    cache = ResultCache(max_size = 2)
+    cache.put('a', {'r': 1})
+    cache.put('b', {'r': 2})
+    assert cache.get('a') == {'r': 1}
+    cache.put('c', {'r': 3})
+
+    # b was the least recently used
+    assert cache.get('b') is None
+    assert cache.get('a') == {'r': 1}
+    assert cache.get('c') == {'r': 3}
+    assert len(cache) == 2
+    assert cache.hits == 3
+    assert cache.misses == 1
+
+
+def test_item_keys_not_cached():
+    cache = ResultCache()
+    cache.put('a', {'r': 1, '_item_id': 7, '_dependency_item_id': 3, '_elapsed': 0.1})
+    result = cache.get('a')
+    assert result == {'r': 1}
+
+    # results are copies
+    result['r'] = 2
+    assert cache.get('a') == {'r': 1}
+
+
+def test_directory(tmpdir):
+    cache = ResultCache(directory = str(tmpdir))
+    cache.put('abcdef', {'r': 1})
+
+    other = ResultCache(directory = str(tmpdir))
+    assert other.get('abcdef') == {'r': 1}
+    assert other.get('abcdeg') is None
+    assert other.hits == 1
+    assert other.misses == 1
+
+
+def test_invalid_directory(tmpdir):
+    with pytest.raises(ValueError):
+        ResultCache(directory = str(tmpdir.join('missing')))
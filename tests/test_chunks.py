@@ -0,0 +1,51 @@
+from zmqpipeline.chunks import file_chunks, read_chunk, chunk_records
+import os
+import shutil
+import tempfile
+import pytest
+
+
+RECORDS = ['record-%d' % i for i in range(100)]
+
+
+@pytest.fixture
+def path(request):
+    directory = tempfile.mkdtemp()
+    request.addfinalizer(lambda: shutil.rmtree(directory))
+    path = os.path.join(directory, 'input.txt')
+    with open(path, 'wb') as f:
+        f.write('\n'.join(RECORDS) + '\n')
+    return path
+
+
+def test_chunks_cover_file(path):
+    chunks = list(file_chunks(path, chunk_size = 64))
+    assert len(chunks) > 1
+    offset = 0
+    for chunk in chunks:
+        assert chunk['offset'] == offset
+        offset += chunk['length']
+    assert offset == os.path.getsize(path)
+
+
+def test_chunks_record_aligned(path):
+    for chunk in file_chunks(path, chunk_size = 64):
+        assert read_chunk(chunk).endswith('\n')
+
+
+def test_chunk_records(path):
+    records = []
+    for chunk in file_chunks(path, chunk_size = 64):
+        records.extend(chunk_records(chunk))
+    assert records == RECORDS
+
+
+def test_single_chunk(path):
+    chunks = list(file_chunks(path, chunk_size = 1 << 20))
+    assert len(chunks) == 1
+    assert chunk_records(chunks[0]) == RECORDS
+
+
+def test_empty_file(path):
+    open(path, 'wb').close()
+    assert list(file_chunks(path)) == []
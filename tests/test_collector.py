@@ -28,3 +28,19 @@ def test_handle_finished():
     }
     assert cl.handle_finished(data, '') == data
 
+
+def test_is_duplicate():
+    cl = CollectorFactory.build()
+    assert not cl.is_duplicate('TSK', {'_item_id': 1})
+    assert cl.is_duplicate('TSK', {'_item_id': 1})
+    assert not cl.is_duplicate('OTHER', {'_item_id': 1})
+    assert not cl.is_duplicate('TSK', {})
+    assert not cl.is_duplicate('TSK', {})
+
+def test_dedupe_window():
+    cl = CollectorFactory.build()
+    cl.dedupe_window = 2
+    for item_id in range(3):
+        assert not cl.is_duplicate('TSK', {'_item_id': item_id})
+    # the oldest id has been forgotten
+    assert not cl.is_duplicate('TSK', {'_item_id': 0})
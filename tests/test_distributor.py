@@ -1,7 +1,17 @@
 from factories.distributor import DistributorFactory, COLLECTOR_ACK_ENDPOINT, COLLECTOR_ENDPOINT
 import os, sys, subprocess, time, unittest
 import signal
+import itertools
 import time
+import pytest
+from collections import deque
+import zmq
+from zmqpipeline.scheduler import TokenBucket
+from zmqpipeline.batching import BatchSizer
+from zmqpipeline.routing import HashRing
+from zmqpipeline.journal import Journal
+from zmqpipeline.utils import messages
+from zmqpipeline import Task, TaskType, EndpointAddress
 
 
 def test_instantiation():
@@ -10,6 +20,468 @@ def test_instantiation():
     assert True
 
 
+def test_add_credits():
+    dist = DistributorFactory.build()
+    dist.add_credits('TSK', 'worker-1', 2)
+    dist.add_credits('TSK', 'worker-1', 1)
+    dist.add_credits('TSK', 'worker-2', 1)
+    assert dist.credits['worker-1'] == 3
+    assert list(dist.waiting_workers['TSK']) == ['worker-1', 'worker-2']
+
+
+TaskType.register_type('BARE')
+
+
+class GraphTask(object):
+    is_complete = False
+    stream_dependencies = False
+    priority = 0
+    weight = 1
+    journal = None
+    n_expired = 0
+
+    def __init__(self, task_type, dependencies):
+        self.task_type = task_type
+        self.dependencies = dependencies
+
+
+def test_task_without_work():
+    class BareTask(Task):
+        task_type = TaskType('BARE')
+        endpoint = EndpointAddress('inproc://bare')
+        dependencies = []
+
+    dist = DistributorFactory.build()
+    with pytest.raises(TypeError):
+        dist.register_task_instance(BareTask)
+
+    # tasks streaming their dependencies take their items from their backlog
+    BareTask.stream_dependencies = True
+    dist.register_task_instance(BareTask)
+    dist.close()
+
+
+def test_handle_task_pulling_ahead():
+    class HandleTask(Task):
+        task_type = TaskType('BARE')
+        endpoint = EndpointAddress('inproc://bare')
+        dependencies = []
+        deadline_buffer = 10
+
+        def handle(self, data, address, msgtype):
+            return {}
+
+    dist = DistributorFactory.build()
+    with pytest.raises(TypeError):
+        dist.register_task_instance(HandleTask)
+
+    HandleTask.deadline_buffer = None
+    HandleTask.routing_key = 'key'
+    with pytest.raises(TypeError):
+        dist.register_task_instance(HandleTask)
+
+
+def test_dependency_graph():
+    dist = DistributorFactory.build()
+    dist.tasks = {
+        'A': GraphTask('A', []),
+        'B': GraphTask('B', ['A']),
+        'C': GraphTask('C', ['A', 'B'])
+    }
+    dist.build_dependency_graph()
+    assert dist.active_tasks == set(['A'])
+    assert dist.n_incomplete == 3
+
+    dist.tasks['A'].is_complete = True
+    dist.check_completion(dist.tasks['A'])
+    assert dist.active_tasks == set(['B'])
+
+    dist.tasks['B'].is_complete = True
+    dist.check_completion(dist.tasks['B'])
+    assert dist.active_tasks == set(['C'])
+    assert dist.n_incomplete == 1
+
+
+def test_dependency_cycle():
+    dist = DistributorFactory.build()
+    dist.tasks = {
+        'A': GraphTask('A', ['C']),
+        'B': GraphTask('B', ['A']),
+        'C': GraphTask('C', ['B'])
+    }
+    with pytest.raises(ValueError):
+        dist.build_dependency_graph()
+
+
+class StreamingTask(GraphTask):
+    stream_dependencies = True
+
+    def __init__(self, task_type, dependencies):
+        super(StreamingTask, self).__init__(task_type, dependencies)
+        self.backlog = deque()
+        self.resumed = []
+
+    def resume_items(self, items):
+        self.resumed = items
+
+    def items_from_dependency(self, task_type, ack_item):
+        return [{'x': ack_item['x']}, {'x': -ack_item['x']}]
+
+
+def test_streamed_item_ids():
+    dist = DistributorFactory.build()
+    task = StreamingTask('B', ['A'])
+    items = dist.items_from_dependency(task, 'A', {'_item_id': 7, 'x': 1})
+    assert items == [{'x': 1, '_item_id': 'A:7:0'}, {'x': -1, '_item_id': 'A:7:1'}]
+
+
+def test_resume_streamed_items(tmpdir):
+    journal = Journal(str(tmpdir.join('A.journal')))
+    journal.record_acked([0, 1], [{'_item_id': 0, 'x': 1}, {'_item_id': 1, 'x': 2}])
+    journal.close()
+    journal = Journal(str(tmpdir.join('B.journal')))
+    journal.record_acked(['A:0:0', 'A:0:1', 'A:1:0'])
+    journal.close()
+
+    dist = DistributorFactory.build()
+    dist.tasks = {
+        'A': GraphTask('A', []),
+        'B': StreamingTask('B', ['A'])
+    }
+    dist.tasks['A'].journal = Journal(str(tmpdir.join('A.journal')))
+    dist.tasks['B'].journal = Journal(str(tmpdir.join('B.journal')))
+    dist.build_dependency_graph()
+
+    # only the items of B not done in the previous run are sent
+    dist.resume_streamed_items()
+    assert list(dist.tasks['B'].resumed) == [{'x': -2, '_item_id': 'A:1:1'}]
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.sent = []
+        self.received = deque()
+
+    def send_multipart(self, frames):
+        self.sent.append(frames)
+
+    def recv_multipart(self, flags = 0):
+        if not self.received:
+            raise zmq.Again()
+        return self.received.popleft()
+
+
+class RedeliveryTask(GraphTask):
+    n_sent = 2
+    n_acks = 0
+
+    def __init__(self, task_type):
+        super(RedeliveryTask, self).__init__(task_type, [])
+        self.backlog = deque()
+
+    def update_is_complete(self):
+        return self.is_complete
+
+
+def test_evict_worker():
+    dist = DistributorFactory.build()
+    task = RedeliveryTask('A')
+    dist.tasks = {'A': task}
+    dist.add_client_address('A', 'worker-1')
+    dist.add_credits('A', 'worker-1', 1)
+    dist.worker_tasks['worker-1'] = 'A'
+    dist.in_flight['worker-1'] = {0: {'_item_id': 0}}
+    dist.item_workers[('A', 0)] = 'worker-1'
+
+    dist.evict_worker('worker-1')
+    assert task.n_sent == 1
+    assert list(task.backlog) == [{'_item_id': 0}]
+    assert dist.client_addresses['A'] == set()
+    assert 'worker-1' not in dist.credits
+    assert not dist.waiting_workers['A']
+
+
+def test_late_ack_of_evicted_worker():
+    dist = DistributorFactory.build()
+    task = RedeliveryTask('A')
+    dist.tasks = {'A': task}
+    dist.worker_tasks['worker-1'] = 'A'
+    dist.in_flight['worker-1'] = {0: {'_item_id': 0}}
+    dist.item_workers[('A', 0)] = 'worker-1'
+    n_sent = task.n_sent
+
+    # the evicted worker was alive and ACKs the item before it is sent again
+    dist.evict_worker('worker-1')
+    records = [{'_item_id': 0}]
+    assert dist.complete_in_flight('A', records) == records
+    assert not task.backlog
+    assert task.n_sent == n_sent
+    assert dist.complete_in_flight('A', records) == []
+
+
+def test_evicted_worker_resumes():
+    dist = DistributorFactory.build()
+    task = RedeliveryTask('A')
+    task.client = FakeClient()
+    dist.tasks = {'A': task}
+    dist.worker_initialized['worker-1'] = True
+    dist.worker_tasks['worker-1'] = 'A'
+    dist.evict_worker('worker-1')
+
+    # the evicted worker was alive - its READY grants a credit instead of starting a new handshake
+    task.client.received.append(['worker-1', b'', messages.create_ready('A')])
+    dist.receive_worker_messages(task)
+    assert not dist.pending_inits['A']
+    assert dist.credits['worker-1'] == 1
+    assert not dist.evicted_workers
+
+
+def test_duplicate_acks():
+    dist = DistributorFactory.build()
+    dist.tasks = {
+        'A': RedeliveryTask('A'),
+        'B': StreamingTask('B', ['A'])
+    }
+    dist.build_dependency_graph()
+    records = [{'_item_id': 0, 'x': 1}, {'_item_id': 1, messages.DUPLICATE_KEY: True}]
+
+    # the duplicate is neither counted nor streamed
+    dist.process_sink_ack(messages.create_ack('A', {'_n_items': 1, '_items': records}))
+    assert dist.tasks['A'].n_acks == 1
+    assert [item['_item_id'] for item in dist.tasks['B'].backlog] == ['A:0:0', 'A:0:1']
+
+    # the first ACK of an item in flight counts, even if the collector flags it as a duplicate
+    dist.track_in_flight = True
+    dist.in_flight['worker-1'] = {1: {'_item_id': 1}}
+    dist.item_workers[('A', 1)] = 'worker-1'
+    dist.process_sink_ack(messages.create_ack('A', {'_n_items': 0, '_items': records[1:]}))
+    dist.process_sink_ack(messages.create_ack('A', {'_n_items': 0, '_items': records[1:]}))
+    assert dist.tasks['A'].n_acks == 2
+    assert len(dist.tasks['B'].backlog) == 2
+
+
+def test_complete_in_flight():
+    dist = DistributorFactory.build()
+    dist.in_flight['worker-1'] = {0: {'_item_id': 0}}
+    dist.item_workers[('A', 0)] = 'worker-1'
+    records = [{'_item_id': 0}]
+    assert dist.complete_in_flight('A', records) == records
+    # a second ACK of the same item doesn't count
+    assert dist.complete_in_flight('A', records) == []
+    assert dist.in_flight['worker-1'] == {}
+
+
+def test_speculative_copy():
+    dist = DistributorFactory.build()
+    task = RedeliveryTask('A')
+    task.batch_size = 1
+    task.client = FakeClient()
+    dist.tasks = {'A': task}
+    dist.in_flight['worker-1'] = {0: {'_item_id': 0}}
+    dist.item_workers[('A', 0)] = 'worker-1'
+    dist.add_credits('A', 'worker-1', 1)
+    dist.add_credits('A', 'worker-2', 1)
+
+    # worker-3 has credits left but is busy with an item queued on it
+    dist.in_flight['worker-3'] = {1: {'_item_id': 1}}
+    dist.add_credits('A', 'worker-3', 1)
+
+    assert dist.send_speculative_copy(task, 0)
+    assert dist.speculations[('A', 0)] == 'worker-2'
+    assert task.client.sent[0][0] == 'worker-2'
+    assert list(dist.waiting_workers['A']) == ['worker-1', 'worker-3']
+    # no other idle worker is left
+    dist.speculations.clear()
+    assert not dist.send_speculative_copy(task, 0)
+
+    # the speculative copy takes over when the original worker is evicted
+    dist.speculations[('A', 0)] = 'worker-2'
+    dist.worker_tasks['worker-1'] = 'A'
+    dist.evict_worker('worker-1')
+    assert dist.item_workers[('A', 0)] == 'worker-2'
+    assert not task.backlog
+
+
+def test_steal_from_busy_worker():
+    dist = DistributorFactory.build()
+    task = DispatchTask('A')
+    task.n_sent = 4
+    task.source_exhausted = True
+    task.n_routed = 0
+    task.deadline_heap = []
+    task.client = FakeClient()
+    dist.tasks = {'A': task}
+    dist.active_tasks = set(['A'])
+    dist.add_client_address('A', 'worker-1')
+    dist.add_client_address('A', 'worker-2')
+    dist.credit_workers.update(['worker-1', 'worker-2'])
+    dist.in_flight['worker-1'] = dict((i, {'_item_id': i}) for i in range(4))
+    for i in range(4):
+        dist.item_workers[('A', i)] = 'worker-1'
+        dist.sent_at['A'][i] = i
+    dist.add_credits('A', 'worker-2', 1)
+
+    # the items sent last are revoked
+    dist.steal()
+    assert task.client.sent[0][0] == 'worker-1'
+    data, tt, msgtype = messages.get(task.client.sent[0][2])
+    assert msgtype == messages.MESSAGE_TYPE_REVOKE
+    assert sorted(data) == [2, 3]
+    # the worker isn't asked again before it answers
+    dist.steal()
+    assert len(task.client.sent) == 1
+
+    # the worker already started item 2
+    dist.take_back(task, 'worker-1', {'items': [3], 'n_messages': 1})
+    assert list(task.backlog) == [{'_item_id': 3}]
+    assert task.n_sent == 3
+    assert sorted(dist.in_flight['worker-1']) == [0, 1, 2]
+    assert ('A', 3) not in dist.item_workers
+    assert dist.credits['worker-1'] == 1
+    assert 'worker-1' not in dist.revoking
+
+
+def test_median_latency():
+    dist = DistributorFactory.build()
+    assert dist.median_latency('A') is None
+    dist.latencies['A'].extend([5, 1, 2, 4, 3])
+    assert dist.median_latency('A') == 3
+
+
+class DispatchTask(RedeliveryTask):
+    is_complete = False
+    max_in_flight = None
+    n_acks = 0
+
+    def is_available_for_handling(self, ack_data):
+        return True
+
+
+def test_max_in_flight():
+    dist = DistributorFactory.build()
+    task = DispatchTask('A')
+    task.max_in_flight = 2
+    dist.tasks = {'A': task}
+    dist.add_credits('A', 'worker-1', 1)
+    assert dist.dispatch(task) == 0
+    assert dist.blocked_tasks == set(['A'])
+
+
+class SaturatedTask(DispatchTask):
+    batch_size = 1
+
+    def __init__(self, task_type, priority = 0, weight = 1):
+        super(SaturatedTask, self).__init__(task_type)
+        self.priority = priority
+        self.weight = weight
+        self.client = FakeClient()
+        self.item_ids = itertools.count()
+
+    def handle_batch(self, data, address, msgtype, ack_data = {}):
+        return [{'_item_id': next(self.item_ids)}]
+
+
+def dispatch_shares(tasks, n_passes):
+    dist = DistributorFactory.build()
+    dist.tasks = dict((task.task_type, task) for task in tasks)
+    dist.active_tasks = set(dist.tasks)
+    for task in tasks:
+        # every task has more credits than a pass can use up
+        dist.add_credits(task.task_type, 'worker-' + task.task_type, 10000)
+
+    for _ in range(n_passes):
+        for task in tasks:
+            dist.service_task(task)
+        assert dist.run_scheduler()
+
+    rates = dist.dispatch_rates()
+    total = sum(rates.values())
+    return dict((task_type, rate / total) for task_type, rate in rates.items())
+
+
+def test_scheduler_shares_under_load():
+    shares = dispatch_shares([SaturatedTask('A', weight = 3), SaturatedTask('B', weight = 1)], 20)
+    assert shares['A'] == pytest.approx(0.75, abs = 0.01)
+
+    # lower priority tasks keep a minimum share
+    shares = dispatch_shares([SaturatedTask('HIGH', priority = 1), SaturatedTask('LOW')], 20)
+    assert shares['LOW'] == pytest.approx(0.05, abs = 0.01)
+
+
+def test_adapt_batch_size():
+    dist = DistributorFactory.build()
+    task = DispatchTask('A')
+    task.batch_size = 1
+    dist.batch_sizers['A'] = BatchSizer(100, target_message_rate = 10, latency_budget = 1.0)
+
+    # records without the time workers spent on them are ignored
+    dist.adapt_batch_size(task, [{'_item_id': 0}])
+    assert task.batch_size == 1
+
+    dist.adapt_batch_size(task, [{'_item_id': i, messages.ELAPSED_KEY: 0.005} for i in range(4)])
+    assert task.batch_size == 20
+
+
+def test_rate_limit():
+    dist = DistributorFactory.build()
+    task = DispatchTask('A')
+    task.n_sent = 0
+    dist.tasks = {'A': task}
+    dist.buckets['A'] = TokenBucket(1)
+    dist.buckets['A'].take(1)
+    dist.add_credits('A', 'worker-1', 1)
+    assert dist.dispatch(task) == 0
+    assert 'A' in dist.throttled
+    assert 0 < dist.poll_timeout(None) <= 1000
+    assert dist.poll_timeout(10) == 10
+
+
+def test_routed_items():
+    dist = DistributorFactory.build()
+    task = DispatchTask('A')
+    task.routing_key = 'key'
+    task.n_routed = 0
+    dist.tasks = {'A': task}
+    dist.rings['A'] = HashRing()
+    dist.add_routed_worker(task, 'worker-1')
+
+    items = [{'_item_id': i, 'key': 'key-%d' % i} for i in range(20)]
+    for item in items:
+        dist.route_item(task, item, 'worker-1')
+    task.n_routed = len(items)
+    assert len(dist.routed['A']['worker-1']) == 20
+
+    # a new worker takes over some of the keys
+    dist.add_routed_worker(task, 'worker-2')
+    assert 0 < len(dist.routed['A']['worker-2']) < 20
+    for item in dist.routed['A']['worker-2']:
+        assert dist.rings['A'].get(item['key']) == 'worker-2'
+
+    # and hands them back when it leaves
+    n = len(dist.routed['A']['worker-2'])
+    dist.remove_routed_worker(task, 'worker-2')
+    assert len(task.backlog) == n
+    assert task.n_routed == 20 - n
+
+
+def test_shutdown_without_workers():
+    dist = DistributorFactory.build()
+    task = DispatchTask('A')
+    task.client = dist.context.socket(zmq.ROUTER)
+    dist.tasks = {'A': task}
+    dist.socket_tasks = {task.client: task}
+    dist.add_client_address('A', 'worker-1')
+    dist.add_credits('A', 'worker-1', 1)
+
+    # task B never had a worker connect, worker-1 is waiting and sent END right away
+    dist.tasks['B'] = DispatchTask('B')
+    dist.tasks['B'].client = task.client
+    t = time.time()
+    dist.shutdown(timeout = 5)
+    assert time.time() - t < 1
+    assert task.client.closed
+
+
 def server():
     try:
         for _ in xrange(5, 0, -1):
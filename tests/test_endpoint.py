@@ -1,6 +1,6 @@
 import pytest
 import zmqpipeline
-from zmqpipeline.helpers import valid_endpoint, endpoint_binding
+from zmqpipeline.helpers import valid_endpoint, endpoint_binding, shard_endpoint
 
 
 def test_valid_address():
@@ -39,4 +39,14 @@ def test_binding_2():
 def test_binding_3():
     assert endpoint_binding('ipc://test.ipc') == 'ipc://test.ipc'
 
+def test_shard_endpoint_1():
+    assert shard_endpoint('tcp://localhost:1000', 0) == 'tcp://localhost:1000'
 
+def test_shard_endpoint_2():
+    assert shard_endpoint('tcp://localhost:1000', 2) == 'tcp://localhost:1002'
+
+def test_shard_endpoint_3():
+    assert shard_endpoint('ipc://test.ipc', 1) == 'ipc://test-1.ipc'
+
+def test_shard_endpoint_4():
+    assert shard_endpoint('inproc://test', 3) == 'inproc://test-3'
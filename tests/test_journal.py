@@ -0,0 +1,76 @@
+from zmqpipeline.journal import Journal
+import os
+import shutil
+import tempfile
+import pytest
+
+
+@pytest.fixture
+def path(request):
+    directory = tempfile.mkdtemp()
+    request.addfinalizer(lambda: shutil.rmtree(directory))
+    return os.path.join(directory, 'task.journal')
+
+
+def test_replay(path):
+    journal = Journal(path)
+    journal.record_dispatched([0, 1, 2])
+    journal.record_acked([0, 2])
+    assert journal.is_done(0)
+    assert not journal.is_done(1)
+    journal.close()
+
+    journal = Journal(path)
+    assert journal.done == set([0, 2])
+    assert journal.in_flight == set([1])
+    journal.close()
+
+
+def test_acked_items(path):
+    journal = Journal(path)
+    journal.record_acked([0, 1], [{'_item_id': 0, 'x': 1}, {'_item_id': 1, 'x': 2}])
+    journal.record_acked([2])
+    # only items recorded by previous runs are read back
+    assert list(journal.acked_items()) == []
+    journal.close()
+
+    journal = Journal(path)
+    journal.record_acked([3], [{'_item_id': 3, 'x': 3}])
+    assert journal.done == set([0, 1, 2, 3])
+    assert list(journal.acked_items()) == [{'_item_id': 0, 'x': 1}, {'_item_id': 1, 'x': 2}]
+    journal.close()
+
+
+def test_large_record(path):
+    item = {'_item_id': 0, 'x': 'x' * 70000}
+    journal = Journal(path)
+    journal.record_acked([0], [item])
+    journal.close()
+
+    journal = Journal(path)
+    assert list(journal.acked_items()) == [item]
+    journal.close()
+
+
+def test_batched_sync(path):
+    journal = Journal(path, sync_every = 2, sync_interval = 60)
+    journal.record_acked([0])
+    assert journal.n_unsynced == 1
+    journal.record_acked([1])
+    assert journal.n_unsynced == 0
+    journal.close()
+
+
+def test_torn_record(path):
+    journal = Journal(path)
+    journal.record_acked([0, 'key'])
+    journal.close()
+
+    with open(path, 'ab') as f:
+        f.write('\x05\x00\x92')
+    size = os.path.getsize(path)
+
+    journal = Journal(path)
+    assert journal.done == set([0, 'key'])
+    assert os.path.getsize(path) == size - 3
+    journal.close()
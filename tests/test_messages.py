@@ -63,3 +63,46 @@ def test_create_end_msg():
     assert tt == ''
     assert msgtype == messages.MESSAGE_TYPE_END
 
+
+def test_create_credit_msg():
+    msg = messages.create_credit(TEST_TASK, 5)
+    data, tt, msgtype = messages.get(msg)
+    assert tt == TEST_TASK
+    assert msgtype == messages.MESSAGE_TYPE_CREDIT
+    assert data == 5
+
+def test_create_heartbeat_msg():
+    msg = messages.create_heartbeat(TEST_TASK, 'worker-1')
+    data, tt, msgtype = messages.get(msg)
+    assert tt == TEST_TASK
+    assert msgtype == messages.MESSAGE_TYPE_HEARTBEAT
+    assert data == 'worker-1'
+
+def test_create_batch_msg():
+    items = [{'key': 1}, {'key': 2}]
+    msg = messages.create_batch(TEST_TASK, items)
+    data, tt, msgtype = messages.get(msg)
+    assert tt == TEST_TASK
+    assert msgtype == messages.MESSAGE_TYPE_BATCH
+    assert data == items
+
+def test_carry_item_keys():
+    result = messages.carry_item_keys({'_item_id': 3, 'key': 'value'}, {'result': 1})
+    assert result == {'_item_id': 3, 'result': 1}
+
+def test_create_revoke_msg():
+    msg = messages.create_revoke(TEST_TASK, [1, 2])
+    data, tt, msgtype = messages.get(msg)
+    assert tt == TEST_TASK
+    assert msgtype == messages.MESSAGE_TYPE_REVOKE
+    assert data == [1, 2]
+
+def test_item_ids():
+    assert messages.item_ids({'_item_id': 3, 'key': 1}, messages.MESSAGE_TYPE_DATA) == [3]
+    assert messages.item_ids([{'_item_id': 1}, {'_item_id': 2}], messages.MESSAGE_TYPE_BATCH) == [1, 2]
+    assert messages.item_ids({'key': 1}, messages.MESSAGE_TYPE_DATA) == []
+
+def test_add_elapsed():
+    results = [{'_elapsed': 1.0}, {}]
+    messages.add_elapsed(results, 4.0)
+    assert results == [{'_elapsed': 3.0}, {'_elapsed': 2.0}]
@@ -0,0 +1,57 @@
+from zmqpipeline.result_buffer import ResultBuffer
+from zmqpipeline.utils import messages
+import pytest
+import time
+
+
+class FakeSocket(object):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, msg):
+        self.sent.append(messages.get(msg))
+
+
+def test_unbuffered():
+    socket = FakeSocket()
+    results = ResultBuffer(socket, 'A')
+    results.add(messages.MESSAGE_TYPE_DATA, {'x': 1})
+    results.add(messages.MESSAGE_TYPE_BATCH, [{'x': 2}, {'x': 3}])
+    assert socket.sent == [
+        ({'x': 1}, 'A', messages.MESSAGE_TYPE_DATA),
+        ([{'x': 2}, {'x': 3}], 'A', messages.MESSAGE_TYPE_BATCH)
+    ]
+    assert results.timeout() is None
+
+
+def test_flush_when_full():
+    socket = FakeSocket()
+    results = ResultBuffer(socket, 'A', max_size = 3, flush_interval = 10)
+    results.add(messages.MESSAGE_TYPE_DATA, {'x': 1})
+    results.add(messages.MESSAGE_TYPE_DATA, {'x': 2})
+    assert socket.sent == []
+    assert len(results) == 2
+
+    results.add(messages.MESSAGE_TYPE_BATCH, [{'x': 3}, {'x': 4}])
+    assert socket.sent == [([{'x': 1}, {'x': 2}, {'x': 3}, {'x': 4}], 'A', messages.MESSAGE_TYPE_BATCH)]
+    assert len(results) == 0
+
+
+def test_flush_when_due():
+    socket = FakeSocket()
+    results = ResultBuffer(socket, 'A', max_size = 100, flush_interval = 0.05)
+    results.add(messages.MESSAGE_TYPE_DATA, {'x': 1})
+    assert 0 < results.timeout() <= 50
+
+    results.flush_if_due()
+    assert socket.sent == []
+
+    time.sleep(0.06)
+    assert results.timeout() == 0
+    results.flush_if_due()
+    assert socket.sent == [([{'x': 1}], 'A', messages.MESSAGE_TYPE_BATCH)]
+
+
+def test_invalid_size():
+    with pytest.raises(ValueError):
+        ResultBuffer(FakeSocket(), 'A', max_size = 0)
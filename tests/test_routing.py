@@ -0,0 +1,47 @@
+from zmqpipeline.routing import HashRing, hash_key
+
+
+KEYS = ['key-%d' % i for i in range(200)]
+
+
+def test_hash_key():
+    assert hash_key('key') == hash_key('key')
+    assert hash_key('key') != hash_key('other')
+
+
+def test_empty_ring():
+    assert HashRing().get('key') is None
+
+
+def test_all_nodes_used():
+    ring = HashRing()
+    for node in ('a', 'b', 'c'):
+        ring.add(node)
+    assert set(ring.get(key) for key in KEYS) == set(['a', 'b', 'c'])
+
+
+def test_remove_moves_only_owned_keys():
+    ring = HashRing()
+    for node in ('a', 'b', 'c'):
+        ring.add(node)
+    before = dict((key, ring.get(key)) for key in KEYS)
+
+    ring.remove('c')
+    assert 'c' not in ring
+    for key in KEYS:
+        if before[key] != 'c':
+            assert ring.get(key) == before[key]
+        else:
+            assert ring.get(key) in ('a', 'b')
+
+
+def test_add_moves_keys_to_new_node_only():
+    ring = HashRing()
+    ring.add('a')
+    ring.add('b')
+    before = dict((key, ring.get(key)) for key in KEYS)
+
+    ring.add('c')
+    assert len(ring) == 3
+    for key in KEYS:
+        assert ring.get(key) in (before[key], 'c')
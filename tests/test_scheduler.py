@@ -0,0 +1,102 @@
+from zmqpipeline.scheduler import Scheduler, RateMeter, TokenBucket
+import pytest
+
+
+class ScheduledTask(object):
+    def __init__(self, task_type, priority = 0, weight = 1):
+        self.task_type = task_type
+        self.priority = priority
+        self.weight = weight
+
+
+def run(scheduler, tasks, n):
+    order = []
+    for task in tasks:
+        scheduler.add(task)
+    for _ in range(n):
+        task = scheduler.pop()
+        order.append(task.task_type)
+        scheduler.charge(task, 1)
+        scheduler.add(task)
+    return order
+
+
+def test_priority():
+    high = ScheduledTask('HIGH', priority = 1)
+    low = ScheduledTask('LOW')
+    order = run(Scheduler(), [low, high], 3)
+    assert order == ['HIGH', 'HIGH', 'HIGH']
+
+
+def test_min_share():
+    high = ScheduledTask('HIGH', priority = 1)
+    low = ScheduledTask('LOW')
+    order = run(Scheduler(min_share = 0.05), [low, high], 200)
+    assert order.count('LOW') == 10
+
+    order = run(Scheduler(min_share = 0), [low, high], 200)
+    assert order.count('LOW') == 0
+
+
+def test_min_share_per_level():
+    high = ScheduledTask('HIGH', priority = 1)
+    lows = [ScheduledTask('LOW-%d' % i) for i in range(10)]
+    scheduler = Scheduler(min_share = 0.05)
+    order = run(scheduler, [high] + lows, 400)
+
+    # lower priority tasks share the minimum share of their level, which alone keeps earnings
+    assert len([t for t in order if t.startswith('LOW')]) == 20
+    assert len(set(t for t in order if t.startswith('LOW'))) == 10
+    assert list(scheduler.earned) == [0]
+
+
+def test_invalid_min_share():
+    with pytest.raises(ValueError):
+        Scheduler(min_share = 1)
+
+
+def test_weighted_share():
+    heavy = ScheduledTask('HEAVY', weight = 3)
+    light = ScheduledTask('LIGHT', weight = 1)
+    order = run(Scheduler(), [heavy, light], 40)
+    assert order.count('HEAVY') == 30
+    assert order.count('LIGHT') == 10
+
+
+def test_add_is_idempotent():
+    scheduler = Scheduler()
+    task = ScheduledTask('TSK')
+    scheduler.add(task)
+    scheduler.add(task)
+    assert scheduler.pop() is task
+    assert scheduler.pop() is None
+
+
+def test_dispatch_rates():
+    scheduler = Scheduler(rate_window = 10.0)
+    scheduler.charge(ScheduledTask('TSK'), 50)
+    assert scheduler.dispatch_rates() == {'TSK': 5.0}
+
+
+def test_rate_meter_window():
+    meter = RateMeter(window = 1.0)
+    meter.add(10, now = 100.0)
+    meter.add(5, now = 100.5)
+    assert meter.rate(now = 100.9) == 15.0
+    assert meter.rate(now = 101.2) == 5.0
+
+
+def test_token_bucket():
+    bucket = TokenBucket(10, burst = 2)
+    now = bucket.last
+    assert bucket.wait_time(now) == 0
+    bucket.take(2, now)
+    assert bucket.wait_time(now) == pytest.approx(0.1)
+    assert bucket.wait_time(now + 0.2) == 0
+
+
+def test_token_bucket_overdraft():
+    bucket = TokenBucket(10, burst = 1)
+    now = bucket.last
+    bucket.take(5, now)
+    assert bucket.wait_time(now) == pytest.approx(0.5)
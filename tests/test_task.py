@@ -1,7 +1,8 @@
 from zmqpipeline.task import Task
+import time
 from zmqpipeline import TaskType
 from zmqpipeline.utils import messages
-from factories.task import TaskFactory, TASK_TYPE_MY_TASK, ENDPOINT_ADDRESS
+from factories.task import TaskFactory, StreamingTaskFactory, TASK_TYPE_MY_TASK, ENDPOINT_ADDRESS, N_STREAMING_ITEMS
 
 
 def test_initialization():
@@ -39,3 +40,112 @@ def test_task_handle():
     }
     assert task.handle(data, '', messages.MESSAGE_TYPE_DATA)
 
+
+
+def test_task_handle_batch():
+    task = TaskFactory.build()
+    task.batch_size = 3
+    data = {
+        'key': 'value'
+    }
+    items = task.handle_batch(data, '', messages.MESSAGE_TYPE_READY)
+    assert items == [data, data, data]
+
+
+def test_streaming_task():
+    task = StreamingTaskFactory.build()
+    task.batch_size = 2
+    sent = []
+    while not task.source_exhausted:
+        sent.extend(task.handle_batch({}, '', messages.MESSAGE_TYPE_READY))
+    assert sent == [{'index': i, '_item_id': i} for i in range(N_STREAMING_ITEMS)]
+    assert task.handle_batch({}, '', messages.MESSAGE_TYPE_READY) == []
+
+    task.n_sent = len(sent)
+    assert not task.update_is_complete()
+    task.n_acks = len(sent)
+    assert task.update_is_complete()
+
+
+def test_items_from_dependency():
+    task = TaskFactory.build()
+    items = task.items_from_dependency(TaskType(TASK_TYPE_MY_TASK), {'_item_id': 7, 'key': 'value'})
+    assert items == [{'_dependency_item_id': 7, 'key': 'value'}]
+
+
+def test_backlog_dispatched_first():
+    task = StreamingTaskFactory.build()
+    task.batch_size = 2
+    task.backlog.append({'index': 'redelivered'})
+    items = task.handle_batch({}, '', messages.MESSAGE_TYPE_READY)
+    assert items == [{'index': 'redelivered'}, {'index': 0, '_item_id': 0}]
+
+
+def test_resumed_items_dispatched_first():
+    task = StreamingTaskFactory.build()
+    task.batch_size = 2
+    task.backlog.append({'index': 'redelivered'})
+    task.resume_items(iter([{'index': 'resumed'}]))
+    items = task.handle_batch({}, '', messages.MESSAGE_TYPE_READY)
+    assert items == [{'index': 'resumed'}, {'index': 'redelivered'}]
+    assert task._resumed is None
+
+
+def test_sharded_streaming_task():
+    task = StreamingTaskFactory.build()
+    task.batch_size = 10
+    task.shard_index = 1
+    task.n_shards = 2
+    items = task.handle_batch({}, '', messages.MESSAGE_TYPE_READY)
+    assert items == [{'index': 1, '_item_id': 1}, {'index': 3, '_item_id': 3}]
+    assert task.source_exhausted
+
+
+class DoneJournal(object):
+    def is_done(self, item_id):
+        return item_id % 2 == 0
+
+
+def test_journaled_items_skipped():
+    task = StreamingTaskFactory.build()
+    task.batch_size = 10
+    task.journal = DoneJournal()
+    items = task.handle_batch({}, '', messages.MESSAGE_TYPE_READY)
+    assert items == [{'index': 1, '_item_id': 1}, {'index': 3, '_item_id': 3}]
+
+
+def deadline_items(now):
+    return [
+        {'index': 0, '_deadline': now + 30},
+        {'index': 1},
+        {'index': 2, '_deadline': now + 10},
+        {'index': 3, '_deadline': now - 1}
+    ]
+
+
+def test_earliest_deadline_first():
+    task = StreamingTaskFactory.build()
+    now = time.time()
+    task.items = lambda: deadline_items(now)
+    task.deadline_buffer = 10
+    task.batch_size = 2
+    items = task.handle_batch({}, '', messages.MESSAGE_TYPE_READY)
+    assert [item['index'] for item in items] == [2, 0]
+    assert task.n_expired == 1
+    items = task.handle_batch({}, '', messages.MESSAGE_TYPE_READY)
+    assert [item['index'] for item in items] == [1]
+    assert task.handle_batch({}, '', messages.MESSAGE_TYPE_READY) == []
+
+
+def test_expired_item_replaced():
+    task = StreamingTaskFactory.build()
+    now = time.time()
+    task.items = lambda: deadline_items(now)
+    task.handle_expired = lambda item: {'index': item['index'], 'degraded': True}
+    task.deadline_buffer = 10
+    task.deadline_margin = 20
+    task.batch_size = 10
+    items = task.handle_batch({}, '', messages.MESSAGE_TYPE_READY)
+    assert [item['index'] for item in items] == [3, 2, 0, 1]
+    assert [item.get('degraded', False) for item in items] == [True, True, False, False]
+    assert task.n_expired == 2
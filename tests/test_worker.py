@@ -1,4 +1,13 @@
-from factories.worker import MetaDataWorkerFactory, SingleThreadedWorkerFactory, MultiThreadedWorkerFactory
+import os
+from collections import deque
+from threading import Thread
+
+import pytest
+import zmq
+from zmqpipeline.utils import messages
+from zmqpipeline.cache import ResultCache, CACHE_KEY
+from factories.worker import MetaDataWorkerFactory, SingleThreadedWorkerFactory, MultiThreadedWorkerFactory,\
+    CreditWorkerFactory, MultiProcessWorkerFactory, GreenWorkerFactory
 
 def test_meta_instantiation():
     MetaDataWorkerFactory.build()
@@ -9,3 +18,149 @@ def test_single_worker_instantiation():
 def test_multi_worker_instantiation():
     MultiThreadedWorkerFactory.build()
 
+def test_multi_thread_worker_credit_window():
+    w = MultiThreadedWorkerFactory.build()
+    assert w.credit_window == 2 * w.n_threads
+    assert w.thread_router.socket_type == zmq.ROUTER
+
+def test_shutdown_threads():
+    w = MultiThreadedWorkerFactory.build()
+    w.init_threads()
+    w.shutdown_threads()
+    w.thread_router.close()
+
+def test_multi_process_worker_instantiation():
+    w = MultiProcessWorkerFactory.build()
+    assert w.process_endpoint.startswith('ipc://')
+    assert os.path.isdir(w.process_dir)
+    w.shutdown_processes()
+    assert not os.path.exists(w.process_dir)
+
+def test_process_recycled_after_max_tasks():
+    w = MultiProcessWorkerFactory.build(max_tasks_per_process = 2, process_linger = 0)
+
+    # run the child loop on a thread, so the test can see it exit
+    t = Thread(target = w.worker_process, args = [0])
+    t.start()
+    for x in range(2):
+        identity, empty, msg = w.process_router.recv_multipart()
+        w.process_router.send_multipart([identity, b'', messages.create_data(w.task_type, {'x': x})])
+    t.join(5)
+    assert not t.is_alive()
+    w.shutdown_processes()
+
+class CrashedProcess(object):
+    pid = 1234
+    exitcode = -9
+
+    def is_alive(self):
+        return False
+
+    def join(self):
+        pass
+
+def test_crashed_process_messages_handed_off():
+    w = MultiProcessWorkerFactory.build()
+    w.shutdown_processes()
+    started = []
+    w.start_process = started.append
+    msg = messages.create_data(w.task_type, {'x': 1})
+
+    w.processes = {0: CrashedProcess()}
+    w.held['1234'] = [(msg, 0)]
+    w.reap_processes()
+    assert started == [0]
+    assert list(w.lost) == [(msg, 1)]
+
+    # a message crashing every process it's sent to eventually fails
+    sent = []
+    w.sender.send = sent.append
+    w.lost.clear()
+    w.held['1234'] = [(messages.create_data(w.task_type, {'x': 1, '_item_id': 7}), w.max_process_crashes - 1)]
+    w.reap_processes()
+    assert not w.lost
+    assert [messages.get(m) for m in sent] == [({'_item_id': 7}, w.task_type, messages.MESSAGE_TYPE_FAILURE)]
+
+def test_lockstep_worker_socket():
+    w = SingleThreadedWorkerFactory.build()
+    assert not w.credit_mode
+    assert w.worker.socket_type == zmq.REQ
+
+def test_credit_window_keyword():
+    w = SingleThreadedWorkerFactory.build(credit_window = 8)
+    assert w.credit_mode
+    assert w.worker.socket_type == zmq.DEALER
+
+def test_credits_returned_in_batches():
+    w = CreditWorkerFactory.build()
+    sent = []
+    w.send_to_distributor = sent.append
+
+    w.work_done()
+    assert sent == []
+    w.work_done()
+    assert [messages.get(msg) for msg in sent] == [(2, w.task_type, messages.MESSAGE_TYPE_CREDIT)]
+    assert w.unreturned_credits == 0
+
+def test_credit_worker_socket():
+    w = CreditWorkerFactory.build()
+    assert w.credit_mode
+    assert w.worker.socket_type == zmq.DEALER
+
+def test_green_worker_credit_window():
+    pytest.importorskip('gevent')
+    w = GreenWorkerFactory.build()
+    assert w.credit_window == 50
+    assert w.credit_mode
+    assert w.pool.size == 50
+
+def test_cached_execution():
+    w = SingleThreadedWorkerFactory.build()
+    w.cache = ResultCache(10)
+    calls = []
+    w.handle_execution = lambda data: calls.append(data) or {'r': data['x'] * 2}
+
+    def untimed(results):
+        # results carry the time they took, which is never cached
+        for result in results:
+            assert result.pop(messages.ELAPSED_KEY) >= 0
+        return results
+
+    assert untimed([w.execute({'x': 1, '_item_id': 1})]) == [{'r': 2, '_item_id': 1}]
+    assert untimed([w.execute({'x': 1, '_item_id': 2})]) == [{'r': 2, '_item_id': 2}]
+    assert untimed(w.execute_batch([{'x': 1, '_item_id': 3}, {'x': 2, '_item_id': 4}])) == [
+        {'r': 2, '_item_id': 3}, {'r': 4, '_item_id': 4}
+    ]
+    assert len(calls) == 2
+    assert w.cache.hits == 2
+    assert w.cache.misses == 2
+
+def test_cached_hand_off():
+    w = MultiThreadedWorkerFactory.build()
+    w.cache = ResultCache(10)
+    sent = []
+    w.results.socket = type('FakeSocket', (object,), {'send': lambda self, msg: sent.append(messages.get(msg))})()
+
+    # misses are handed off tagged with their cache key, and cached by the thread
+    ids, smsg = w.hand_off(messages.create_data(w.task_type, {'x': 3, '_item_id': 1}))
+    assert ids == [1]
+    data, tt, msgtype = messages.get(smsg)
+    assert CACHE_KEY in data
+    msgtype, result = w.execute_in_pool(data, msgtype, 0)
+    assert result.pop(messages.ELAPSED_KEY) >= 0
+    assert result == {'x': 3, '_item_id': 1}
+
+    # hits are sent straight to the collector
+    assert w.hand_off(messages.create_data(w.task_type, {'x': 3, '_item_id': 2})) is None
+    assert sent == [([{'x': 3, '_item_id': 2}], w.task_type, messages.MESSAGE_TYPE_BATCH)]
+
+def test_revoke_unstarted_messages():
+    w = SingleThreadedWorkerFactory.build(credit_window = 8)
+    sent = []
+    w.send_to_distributor = lambda msg: sent.append(messages.get(msg))
+    queue = deque([([1], 'a'), ([2, 3], 'b'), ([4], 'c')])
+
+    # the message holding items 2 and 3 is only taken out with both of them
+    w.revoke(queue, [2, 4])
+    assert list(queue) == [([1], 'a'), ([2, 3], 'b')]
+    assert sent == [({'items': [4], 'n_messages': 1}, w.task_type, messages.MESSAGE_TYPE_REVOKE)]
@@ -2,7 +2,8 @@ from collector import Collector
 from descriptors import EndpointAddress, TaskType
 from distributor import Distributor
 from task import Task
-from worker import SingleThreadedWorker, MultiThreadedWorker, MetaDataWorker, ServiceWorker
+from worker import SingleThreadedWorker, MultiThreadedWorker, MultiProcessWorker, GreenWorker, MetaDataWorker,\
+    ServiceWorker
 from service import Service
 from clients import ServiceClient
 
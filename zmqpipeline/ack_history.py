@@ -0,0 +1,61 @@
+from collections import defaultdict, deque
+import logging
+
+logger = logging.getLogger('zmqpipeline.ack_history')
+
+
+class AckHistory(object):
+    """
+    A bounded history of the ACKs received from the collector, indexed on ACK id and task type.
+
+    Only the most recent ACKs are kept: once the history is full, the oldest ACK is forgotten.
+    """
+    def __init__(self, max_size = 1000):
+        if max_size < 1:
+            raise ValueError('max_size must be a positive integer')
+
+        self.max_size = max_size
+        self.acks = deque()
+        self.by_id = {}
+        self.by_task_type = defaultdict(deque)
+
+    def __len__(self):
+        return len(self.acks)
+
+    def __contains__(self, ack_id):
+        return ack_id in self.by_id
+
+    def add(self, ack_data):
+        """
+        Records an ACK, forgetting the oldest ACK if the history is full.
+
+        :param dict ack_data: The data of the ACK, including _id and _task_type
+        """
+        if len(self.acks) >= self.max_size:
+            old = self.acks.popleft()
+            self.by_id.pop(old.get('_id'), None)
+            self.by_task_type[old.get('_task_type')].popleft()
+
+        self.acks.append(ack_data)
+        self.by_id[ack_data.get('_id')] = ack_data
+        self.by_task_type[ack_data.get('_task_type')].append(ack_data)
+
+    def get(self, ack_id, default = None):
+        """
+        :return dict: The ACK with the given id, or default if it isn't in the history
+        """
+        return self.by_id.get(ack_id, default)
+
+    def latest(self, task_type = None):
+        """
+        :param task_type: If given, only consider ACKs of this task type
+        :return dict: The most recent ACK, or an empty dictionary if there is none
+        """
+        acks = self.acks if task_type is None else self.by_task_type.get(task_type)
+        return acks[-1] if acks else {}
+
+    def for_task(self, task_type):
+        """
+        :return list: The ACKs of a task type in the history, oldest first
+        """
+        return list(self.by_task_type.get(task_type, ()))
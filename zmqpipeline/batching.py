@@ -0,0 +1,59 @@
+import math
+import logging
+
+logger = logging.getLogger('zmqpipeline.batching')
+
+
+class BatchSizer(object):
+    """
+    Adapts the batch size of a task to the per-item service time workers report in ACKs.
+
+    The batch size is the smallest that keeps each worker under the target message rate, so small items are
+    amortized over few messages, but never so large that a message takes longer than the latency budget to
+    process, so big items aren't delayed behind each other.
+    """
+    def __init__(self, max_batch_size, target_message_rate, latency_budget, smoothing = 0.2):
+        """
+        :param int max_batch_size: The largest batch size allowed
+        :param float target_message_rate: The number of messages per second each worker should process at most
+        :param float latency_budget: The number of seconds a worker should take to process a message at most
+        :param float smoothing: The weight of each new observation in the moving average of the item time
+        """
+        if max_batch_size < 1:
+            raise ValueError('max_batch_size must be a positive integer')
+        if target_message_rate <= 0 or latency_budget <= 0:
+            raise ValueError('target_message_rate and latency_budget must be positive')
+
+        self.max_batch_size = max_batch_size
+        self.target_message_rate = target_message_rate
+        self.latency_budget = latency_budget
+        self.smoothing = smoothing
+        self.item_time = None
+
+    def observe(self, elapsed, n_items):
+        """
+        Accounts for n_items that took workers elapsed seconds to process.
+        """
+        if n_items < 1:
+            return
+
+        item_time = float(elapsed) / n_items
+        if self.item_time is None:
+            self.item_time = item_time
+        else:
+            self.item_time += self.smoothing * (item_time - self.item_time)
+
+    def batch_size(self, default = 1):
+        """
+        :param int default: The batch size to use until an item time has been observed
+        :return int: The batch size for the item time observed so far
+        """
+        if self.item_time is None:
+            return default
+        if self.item_time <= 0:
+            return self.max_batch_size
+
+        # the smallest batch meeting the message rate, capped by the latency budget
+        size = int(math.ceil(1.0 / (self.item_time * self.target_message_rate)))
+        size = min(size, int(self.latency_budget / self.item_time))
+        return max(1, min(size, self.max_batch_size))
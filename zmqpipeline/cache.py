@@ -0,0 +1,131 @@
+from collections import OrderedDict
+import errno
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+import msgpack
+
+from utils import messages
+
+logger = logging.getLogger('zmqpipeline.cache')
+
+# the key under which pool workers carry an item's cache key from the worker to the thread or process handling it
+CACHE_KEY = '_cache_key'
+
+# keys that identify, schedule or time an item rather than describe its work, left out of cache keys and cached results
+UNCACHED_KEYS = messages.ITEM_KEYS + (messages.ELAPSED_KEY, CACHE_KEY, '_dependency_item_id', '_deadline')
+
+
+def canonical(value):
+    """
+    :return: The value with dictionaries replaced by lists of key, value pairs sorted by key, so equal values
+        always serialize to the same bytes. Dictionaries and lists are tagged, so a dictionary never serializes
+        like a list of its pairs
+    """
+    if isinstance(value, dict):
+        return ['__dict__', [[k, canonical(v)] for k, v in sorted(value.items())]]
+    if isinstance(value, (list, tuple)):
+        return ['__list__', [canonical(v) for v in value]]
+    return value
+
+
+def cache_key(data):
+    """
+    :return str: A hash of an item that is stable across processes and hosts, leaving out UNCACHED_KEYS
+    """
+    data = dict((k, v) for k, v in (data or {}).items() if k not in UNCACHED_KEYS)
+    return hashlib.sha1(msgpack.packb(canonical(data))).hexdigest()
+
+
+class ResultCache(object):
+    """
+    Caches results by the cache key of the item they were produced from.
+
+    The most recently used max_size results are kept in memory. When a directory is given, every result is also
+    written to a file of its own there, so the workers of a host share their results and keep them across runs.
+    Files are written to a temporary name and renamed, so concurrent readers never see a partial result.
+    """
+    def __init__(self, max_size = 1000, directory = None):
+        """
+        :param int max_size: The number of results kept in memory
+        :param str directory: If given, an existing directory results are also stored in
+        """
+        if max_size < 1:
+            raise ValueError('max_size must be a positive integer')
+        if directory and not os.path.isdir(directory):
+            raise ValueError('directory must be an existing directory')
+
+        self.max_size = max_size
+        self.directory = directory
+        self.entries = OrderedDict()
+        # threads of a multi threaded worker share the cache
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """
+        :return dict: A copy of the result cached under key, or None if there is none
+        """
+        with self.lock:
+            result = self.entries.pop(key, None)
+            if result is None and self.directory:
+                result = self.read(key)
+            if result is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.remember(key, result)
+            return dict(result)
+
+    def put(self, key, result):
+        """
+        Caches a result, leaving out UNCACHED_KEYS, which belong to the item it was produced from.
+        """
+        result = dict((k, v) for k, v in (result or {}).items() if k not in UNCACHED_KEYS)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.remember(key, result)
+        if self.directory:
+            self.write(key, result)
+
+    def remember(self, key, result):
+        self.entries[key] = result
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last = False)
+
+    def read(self, key):
+        try:
+            with open(self.path(key), 'rb') as f:
+                return msgpack.unpackb(f.read())
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                logger.warning('Could not read cached result %s: %s', key, e)
+            return None
+
+    def write(self, key, result):
+        path = self.path(key)
+        try:
+            try:
+                os.mkdir(os.path.dirname(path))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+            fd, tmp = tempfile.mkstemp(dir = os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(msgpack.packb(result))
+            os.rename(tmp, path)
+        except (IOError, OSError) as e:
+            logger.warning('Could not write cached result %s: %s', key, e)
@@ -0,0 +1,72 @@
+import mmap
+import os
+import logging
+
+logger = logging.getLogger('zmqpipeline.chunks')
+
+
+def file_chunks(path, chunk_size = 4 * 1024 * 1024, delimiter = b'\n'):
+    """
+    Splits a file into chunks of about chunk_size bytes that end on a record delimiter, without reading it.
+    The file is memory-mapped, and only the bytes around each chunk boundary are scanned for the next delimiter.
+
+    Return this from Task.items() to dispatch only chunk descriptors. Workers read their chunk with read_chunk(),
+    so the path must be readable by the workers at the same location, on local or shared storage.
+
+    :param str path: The path of the file
+    :param int chunk_size: The approximate size of each chunk in bytes
+    :param str delimiter: The delimiter records end with
+    :return: A generator of dictionaries with the path, offset and length of each chunk
+    """
+    if chunk_size < 1:
+        raise ValueError('chunk_size must be a positive integer')
+
+    path = os.path.abspath(path)
+    size = os.path.getsize(path)
+    if not size:
+        return
+
+    logger.info('Splitting %s (%d bytes) into chunks of about %d bytes', path, size, chunk_size)
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            offset = 0
+            while offset < size:
+                end = offset + chunk_size
+                if end < size:
+                    # extend the chunk to the end of the record it splits
+                    i = mm.find(delimiter, end - len(delimiter))
+                    end = size if i == -1 else i + len(delimiter)
+                else:
+                    end = size
+
+                yield {'path': path, 'offset': offset, 'length': end - offset}
+                offset = end
+        finally:
+            mm.close()
+
+
+def read_chunk(chunk):
+    """
+    Reads the bytes of a chunk produced by file_chunks(). Invoke this on the worker.
+
+    :param dict chunk: A chunk descriptor with the path, offset and length
+    :return str: The bytes of the chunk
+    """
+    with open(chunk['path'], 'rb') as f:
+        f.seek(chunk['offset'])
+        return f.read(chunk['length'])
+
+
+def chunk_records(chunk, delimiter = b'\n'):
+    """
+    Reads the records of a chunk produced by file_chunks(). Invoke this on the worker.
+
+    :param dict chunk: A chunk descriptor with the path, offset and length
+    :param str delimiter: The delimiter records end with
+    :return list: The records of the chunk, without their delimiter
+    """
+    data = read_chunk(chunk)
+    if data.endswith(delimiter):
+        data = data[:-len(delimiter)]
+    return data.split(delimiter) if data else []
@@ -1,4 +1,5 @@
 import logging
+from collections import defaultdict, deque
 from abc import ABCMeta, abstractmethod, abstractproperty
 import zmq
 from utils import messages
@@ -22,6 +23,14 @@ class Collector(object):
     """
     __metaclass__ = CollectorMeta
 
+    # the number of sharded distributors feeding this collector. Each shard gets its own ACK endpoint,
+    # and the collector finishes once every shard has sent its END signal
+    n_shards = 1
+
+    # the number of most recently collected item ids remembered per task type. Results for an item id collected
+    # before, such as the losing copy of a speculatively re-executed item, are dropped. Zero disables this
+    dedupe_window = 10000
+
     @abstractproperty
     def endpoint(self):
         """
@@ -57,13 +66,24 @@ class Collector(object):
         self.receiver = self.context.socket(zmq.PULL)
         self.receiver.bind(helpers.endpoint_binding(self.endpoint))
 
-        logger.info('Connecting to endpoint %s', self.ack_endpoint)
-        self.ack_sender = self.context.socket(zmq.PUSH)
-        self.ack_sender.bind(helpers.endpoint_binding(self.ack_endpoint))
+        # one ACK channel per distributor shard
+        self.ack_senders = []
+        for shard_index in range(self.n_shards):
+            ack_endpoint = helpers.shard_endpoint(self.ack_endpoint, shard_index)
+            logger.info('Connecting to endpoint %s', ack_endpoint)
+            ack_sender = self.context.socket(zmq.PUSH)
+            ack_sender.bind(helpers.endpoint_binding(ack_endpoint))
+            self.ack_senders.append(ack_sender)
+
+        self.ack_sender = self.ack_senders[0]
         self.metadata = {}
 
         self._ack_id_counter = 1
 
+        # keyed on task types
+        self.collected_ids = defaultdict(set)
+        self.collected_order = defaultdict(deque)
+
 
     @abstractmethod
     def handle_collection(self, data, task_type, msgtype):
@@ -89,6 +109,28 @@ class Collector(object):
         """
         pass
 
+    def is_duplicate(self, task_type, data):
+        """
+        Remembers the item id of a result.
+
+        :return bool: True if a result for the same item has been collected before
+        """
+        if not self.dedupe_window or '_item_id' not in data:
+            return False
+
+        item_id = data['_item_id']
+        ids = self.collected_ids[task_type]
+        if item_id in ids:
+            return True
+
+        order = self.collected_order[task_type]
+        ids.add(item_id)
+        order.append(item_id)
+        if len(order) > self.dedupe_window:
+            ids.discard(order.popleft())
+        return False
+
+
     def get_ack_data(self):
         """
         Optionally override this method to attach data to the ACK that will be sent back to the distributor.
@@ -114,6 +156,7 @@ class Collector(object):
         """
         acks_sent = 0
         ack_id_counter = 1
+        n_ends = 0
         logger.info('Collector is running (main loop procesing)')
 
         while True:
@@ -121,6 +164,11 @@ class Collector(object):
             data, task_type, msgtype = messages.get(msg)
 
             if msgtype == messages.MESSAGE_TYPE_END:
+                n_ends += 1
+                if n_ends < self.n_shards:
+                    logger.info('END message received from %d of %d shards', n_ends, self.n_shards)
+                    continue
+
                 logger.info('END message received')
                 self.handle_finished(data, task_type)
                 break
@@ -130,14 +178,49 @@ class Collector(object):
                 logger.info('Received metadata: %s', self.metadata)
                 continue
 
-            logger.debug('Invoking handle_collection - task_type: %s msgtype: %s data: %s', task_type, msgtype, data)
-            sdata = self.handle_collection(data, task_type, msgtype)
-            if not sdata is None and not isinstance(sdata, dict):
-                raise TypeError('handle_collection must return a dictionary or none. See documentation')
+            if msgtype == messages.MESSAGE_TYPE_BATCH:
+                # a batch of results is handled item by item but acknowledged once
+                items = data or []
+                msgtype = messages.MESSAGE_TYPE_DATA
+            else:
+                items = [data]
+
+            collected = {}
+            records = []
+            n_items = 0
+            for data in items:
+                data = data or {}
+                if self.is_duplicate(task_type, data):
+                    # still ACKed, as the distributor may not have received the ACK of the first result
+                    logger.debug('Dropping duplicate result for item %s - task type: %s', data['_item_id'], task_type)
+                    record = messages.carry_item_keys(data, {})
+                    record[messages.DUPLICATE_KEY] = True
+                    records.append(record)
+                    continue
+
+                logger.debug('Invoking handle_collection - task_type: %s msgtype: %s data: %s', task_type, msgtype, data)
+                sdata = self.handle_collection(data, task_type, msgtype)
+                if not sdata is None and not isinstance(sdata, dict):
+                    raise TypeError('handle_collection must return a dictionary or none. See documentation')
+
+                # one record per item, identifying it to the distributor along with the time the worker spent on it
+                record = messages.carry_item_keys(data, {})
+                if messages.ELAPSED_KEY in data:
+                    record[messages.ELAPSED_KEY] = data[messages.ELAPSED_KEY]
+                if sdata:
+                    collected.update(sdata)
+                    record.update(sdata)
+                records.append(record)
+                n_items += 1
+
+            if not records:
+                continue
 
             ackdata = {
                 '_id': ack_id_counter,
-                '_task_type': task_type
+                '_task_type': task_type,
+                '_n_items': n_items,
+                '_items': records
             }
 
             ad = self.get_ack_data()
@@ -145,11 +228,13 @@ class Collector(object):
                 raise TypeError('get_ack_data() must return a dictionary')
 
             ackdata.update(ad)
-            if sdata:
-                ackdata.update(sdata)
+            ackdata.update(collected)
+
+            # all items of a message come from the same shard
+            shard_index = records[0].get('_shard', 0) if records else 0
 
             logger.debug('Sending ACK %d to distributor with task type: %s and data: %s', ack_id_counter, task_type, ackdata)
-            self.ack_sender.send(messages.create_ack(task_type, ackdata))
+            self.ack_senders[shard_index].send(messages.create_ack(task_type, ackdata))
             acks_sent += 1
             ack_id_counter += 1
 
@@ -1,9 +1,17 @@
 import logging
+import os
+import time
+from collections import defaultdict, deque
 
 from utils import messages
 import helpers
 
+from ack_history import AckHistory
+from batching import BatchSizer
 from descriptors import EndpointAddress
+from journal import Journal
+from routing import HashRing
+from scheduler import Scheduler, TokenBucket
 from task import Task
 import zmq
 
@@ -14,12 +22,22 @@ class Distributor(object):
     Responsible for distributing (pushing) tasks to workers. What gets distributed is determined
     by Tasks, which are user-implementations that configure how the distributor works.
 
-    The pipeline pattern assumes there is only one distributor with one or more registered tasks.
+    The pipeline pattern assumes there is only one distributor with one or more registered tasks, unless
+    the distributor is sharded: several distributors then each own a slice of every task's items, with their
+    own workers and collector ACK channel, and a single collector ends the pipeline once all of them are done.
     """
     task_classes = {}
+    # the most messages sent in one pass of the scheduler, before ACKs and worker messages are read again
+    dispatch_quantum = 100
+    # the least share of dispatch kept by tasks passed over for tasks of a higher priority
+    min_priority_share = 0.05
 
     def __init__(self, collector_endpoint, collector_ack_endpoint,
-                 receive_metadata = False, metadata_endpoint = None):
+                 receive_metadata = False, metadata_endpoint = None,
+                 shard_index = 0, n_shards = 1, ack_history_size = 1000, journal_dir = None,
+                 heartbeat_endpoint = None, heartbeat_timeout = 5.0,
+                 speculation_threshold = None, speculation_factor = 3.0, shutdown_timeout = 10.0,
+                 work_stealing = False):
         """
         Instantiate a distributor.
 
@@ -27,6 +45,16 @@ class Distributor(object):
         :param EndpointAddress collector_ack_endpoint: The endpoint of the collector for receiving ACKs
         :param bool receive_metadata: When true, the distributor will wait for meta data from a meta data worker before distributing tasks to clients
         :param EndpointAddress metadata_endpoint: The endpoint from which to receive meta data from a meta data worker.
+        :param int shard_index: The index of this distributor when running several sharded distributors
+        :param int n_shards: The total number of sharded distributors. Task, ACK and meta data endpoints are offset for each shard, see helpers.shard_endpoint
+        :param int ack_history_size: The number of most recent ACKs kept in the ACK history tasks can query
+        :param str journal_dir: If given, a journal of dispatched and ACKed items is kept in this directory for each task, and items ACKed in a previous run are skipped
+        :param EndpointAddress heartbeat_endpoint: If given, the endpoint on which to receive worker heartbeats. Items sent to workers that stop sending heartbeats are redelivered to other workers
+        :param float heartbeat_timeout: The number of seconds without a heartbeat after which a worker is considered dead
+        :param int speculation_threshold: If given, once fewer than this many items of an exhausted task remain unACKed, straggling items are speculatively sent to a second idle worker
+        :param float speculation_factor: Items are straggling once in flight for longer than this multiple of the task's median item latency
+        :param float shutdown_timeout: The longest time shutdown() waits for workers to be sent END, in seconds
+        :param bool work_stealing: If True, once a task has no items left to send, idle workers take over items queued but not yet started on busy workers in credit mode
         :return: A Distributor object
         """
         logger.info('Initializing distributor')
@@ -38,10 +66,18 @@ class Distributor(object):
         if not isinstance(collector_ack_endpoint, EndpointAddress):
             raise TypeError('collector_ack_endpoint must be an EndpointAddress instance')
 
+        if n_shards < 1 or not 0 <= shard_index < n_shards:
+            raise ValueError('shard_index must be between 0 and n_shards - 1')
+        self.shard_index = shard_index
+        self.n_shards = n_shards
+        if n_shards > 1:
+            logger.info('Running as shard %d of %d', shard_index, n_shards)
+
         logger.info('Connecting to collector endpoint %s', collector_endpoint)
         self.sink = self.context.socket(zmq.PUSH)
         self.sink.connect(collector_endpoint)
 
+        collector_ack_endpoint = self.shard_endpoint(collector_ack_endpoint)
         logger.info('Connecting to collector ACK endpoint %s', collector_ack_endpoint)
         self.sink_ack = self.context.socket(zmq.PULL)
         self.sink_ack.connect(collector_ack_endpoint)
@@ -53,6 +89,7 @@ class Distributor(object):
             if not isinstance(metadata_endpoint, EndpointAddress):
                 raise TypeError('metadata_endpoint must be an EndpointAddress instance')
 
+            metadata_endpoint = self.shard_endpoint(metadata_endpoint)
             logger.info('Connecting to meta data worker endpoint %s', metadata_endpoint)
             self.metadata_client = self.context.socket(zmq.REP)
             self.metadata_client.bind(metadata_endpoint)
@@ -62,23 +99,110 @@ class Distributor(object):
         self.poller = zmq.Poller()
         self.poller.register(self.sink_ack, zmq.POLLIN)
 
+        if heartbeat_endpoint:
+            if not isinstance(heartbeat_endpoint, EndpointAddress):
+                raise TypeError('heartbeat_endpoint must be an EndpointAddress instance')
+            if heartbeat_timeout <= 0:
+                raise ValueError('heartbeat_timeout must be positive')
+
+            heartbeat_endpoint = self.shard_endpoint(heartbeat_endpoint)
+            logger.info('Receiving worker heartbeats on endpoint %s', heartbeat_endpoint)
+            self.heartbeat_receiver = self.context.socket(zmq.PULL)
+            self.heartbeat_receiver.bind(helpers.endpoint_binding(heartbeat_endpoint))
+            self.poller.register(self.heartbeat_receiver, zmq.POLLIN)
+        else:
+            self.heartbeat_receiver = None
+        self.heartbeat_timeout = heartbeat_timeout
+        self.next_expiry_check = 0
+        self.shutdown_timeout = shutdown_timeout
+
+        if speculation_threshold is not None and speculation_factor <= 1:
+            raise ValueError('speculation_factor must be greater than one')
+        self.speculation_threshold = speculation_threshold
+        self.speculation_factor = speculation_factor
+        self.next_speculation_check = 0
+
+        self.work_stealing = work_stealing
+        # the time REVOKE was sent to workers that haven't answered it yet
+        self.revoking = {}
+
+        # in-flight items are tracked when they may be redelivered, speculatively re-executed or stolen
+        self.track_in_flight = self.heartbeat_receiver is not None or speculation_threshold is not None or work_stealing
+
         self.client_addresses = {}
 
         # keyed on worker ids
         self.worker_initialized = {}
+        # initialized workers that were evicted, which resume without a new handshake if they turn out to be alive
+        self.evicted_workers = set()
+        # number of tasks each worker is still willing to receive
+        self.credits = {}
+        # workers in credit mode, which can be sent messages at any time
+        self.credit_workers = set()
+        self.worker_tasks = {}
+        # time of the last heartbeat, only for workers sending heartbeats
+        self.last_heartbeat = {}
+        # items sent but not yet ACKed, keyed on item id
+        self.in_flight = defaultdict(dict)
+        # keyed on (task type, item id)
+        self.item_workers = {}
+        # the worker running the speculative copy of an item, keyed on (task type, item id)
+        self.speculations = {}
+        # keyed on task types, then item ids
+        self.sent_at = defaultdict(dict)
+        # ids of items handed back by evicted workers, keyed on task types
+        self.redelivered = defaultdict(set)
+        # recent times between sending an item and receiving its ACK, keyed on task types
+        self.latencies = defaultdict(lambda: deque(maxlen = 1000))
+
+        # keyed on task types
+        self.waiting_workers = defaultdict(deque)
+        self.pending_inits = defaultdict(list)
         self.clients = {}
         self.tasks = {}
+        self.socket_tasks = {}
+
+        # dependency graph, built once all tasks are registered
+        self.dependents = defaultdict(list)
+        self.stream_dependents = defaultdict(list)
+        self.n_unmet_dependencies = {}
+        self.active_tasks = set()
+        self.blocked_tasks = set()
+        self.n_incomplete = 0
+
+        self.scheduler = Scheduler(min_share = self.min_priority_share)
+
+        # keyed on task types, for tasks routing items by key
+        self.rings = {}
+        # items waiting for the worker they are routed to, keyed on task types then worker addresses
+        self.routed = defaultdict(lambda: defaultdict(deque))
+
+        # keyed on task types, for rate limited tasks
+        self.buckets = {}
+        # the time at which rate limited tasks may be dispatched to again, keyed on task types
+        self.throttled = {}
+
+        # keyed on task types, for tasks with adaptive batch sizes
+        self.batch_sizers = {}
+
+        if journal_dir and not os.path.isdir(journal_dir):
+            raise ValueError('journal_dir must be an existing directory')
+        self.journal_dir = journal_dir
+
+        # data received from collector
+        self.ack_data = {}
+        self.ack_history = AckHistory(ack_history_size)
 
         for taskcls in self.registered_task_classes:
             self.register_task_instance(taskcls)
+        self.build_dependency_graph()
+        if journal_dir:
+            self.resume_streamed_items()
 
         self.receive_metadata = receive_metadata
         if receive_metadata:
             self.wait_for_metadata()
 
-        # data received from collector
-        self.ack_data = {}
-
 
     @property
     def registered_task_classes(self):
@@ -91,6 +215,10 @@ class Distributor(object):
             cls.task_classes[task.task_type] = task
 
 
+    def shard_endpoint(self, endpoint):
+        return EndpointAddress(helpers.shard_endpoint(endpoint, self.shard_index))
+
+
     def wait_for_metadata(self):
         logger.info('Waiting to receive metadata')
         msg = self.metadata_client.recv()
@@ -110,38 +238,538 @@ class Distributor(object):
         self.sink.send(messages.create_metadata(self.metadata))
 
 
-    def process_sink_ack(self):
-        msg = self.sink_ack.recv()
+    def receive_acks(self):
+        """
+        Processes every ACK pending from the collector without blocking.
+
+        :return int: The number of ACKs processed
+        """
+        n_acks = 0
+        while True:
+            try:
+                msg = self.sink_ack.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+
+            self.process_sink_ack(msg)
+            n_acks += 1
+
+        if n_acks:
+            # tasks waiting on an ACK may be available for handling again
+            for task_type in list(self.blocked_tasks):
+                self.service_task(self.tasks[task_type])
+        return n_acks
+
+
+    def process_sink_ack(self, msg):
         data, tt, msgtype = messages.get(msg)
 
-        self.tasks[tt].n_acks += 1
+        # batched results are acknowledged with a single ACK
+        task = self.tasks[tt]
+        records = data.get('_items', [])
+        if self.track_in_flight:
+            # redelivered and speculative items can be ACKed twice - only the first ACK counts, even when the
+            # collector flags it as a duplicate because the distributor missed the ACK of the first result
+            records = self.complete_in_flight(tt, records)
+            task.n_acks += len(records)
+        else:
+            records = [r for r in records if not r.get(messages.DUPLICATE_KEY)]
+            task.n_acks += data.get('_n_items', 1)
+        task.update_is_complete()
         ack_id = data.get('_id', 0)
 
+        if tt in self.batch_sizers and records:
+            self.adapt_batch_size(task, records)
+
         logger.debug('Received ACK ID %d - %d acks from task type %s', ack_id, self.tasks[tt].n_acks, tt)
         # logger.info('Received ACK ID %d - %d acks from task type %s - msgtype: %s', ack_id, self.tasks[tt].n_acks, tt, msgtype)
+        self.ack_data = data or {}
         if data:
-            self.ack_data = data
+            self.ack_history.add(data)
+
+        if task.journal:
+            # tasks streamed from keep their ACKed items, to produce their dependents' items again on resume
+            acked = [r for r in records if '_item_id' in r]
+            task.journal.record_acked([r['_item_id'] for r in acked], acked if self.stream_dependents[tt] else None)
+
+        # feed ACKed items to tasks streaming from this one, before this task can complete
+        for dependent_type in self.stream_dependents[tt]:
+            dependent = self.tasks[dependent_type]
+            for record in records:
+                if record.get(messages.DUPLICATE_KEY):
+                    logger.warning('Item %s - task type %s - was only ACKed as a duplicate, without the collected '
+                                   'data task type %s streams from', record.get('_item_id'), tt, dependent_type)
+                    continue
+                dependent.backlog.extend(self.items_from_dependency(dependent, tt, record))
+            self.service_task(dependent)
+
+        self.check_completion(task)
+
+
+    def items_from_dependency(self, task, task_type, record):
+        """
+        Invokes items_from_dependency() on a task streaming its dependencies. The items are given ids derived from
+        the id of the ACKed item they were produced from, so they are the same on every run whatever the order of ACKs.
+
+        :return list: The items
+        """
+        items = task.items_from_dependency(task_type, record) or []
+        if '_item_id' in record:
+            for index, item in enumerate(items):
+                if isinstance(item, dict) and '_item_id' not in item:
+                    item['_item_id'] = '%s:%s:%d' % (task_type, record['_item_id'], index)
+        return items
+
+
+    def resume_streamed_items(self):
+        """
+        Has tasks streaming their dependencies produce their items again from the items of their dependencies ACKed
+        in previous runs, as their ACKs won't be received again. The ACKed items are read back from the journal as
+        the streaming task takes items, and items the streaming task's journal records as done are skipped.
+        """
+        for task_type, dependent_types in self.stream_dependents.items():
+            for dependent_type in dependent_types:
+                logger.info('Resuming items of task type %s streamed from task type %s', dependent_type, task_type)
+                dependent = self.tasks[dependent_type]
+                dependent.resume_items(self.resumed_items(dependent, task_type))
+
+
+    def resumed_items(self, task, task_type):
+        """
+        :return: A generator of the items of a task streaming from task_type that aren't done yet
+        """
+        for record in self.tasks[task_type].journal.acked_items():
+            if record.get(messages.DUPLICATE_KEY):
+                continue
+            for item in self.items_from_dependency(task, task_type, record):
+                if not isinstance(item, dict) or not task.journal.is_done(item['_item_id']):
+                    yield item
+
+
+    def adapt_batch_size(self, task, records):
+        """
+        Resizes the batches of a task with an adaptive batch size from the time workers spent on the ACKed items.
+        The time between sending and ACKing items would also count the time items wait in the credit window of
+        workers and in their result buffers.
+        """
+        elapsed = [record[messages.ELAPSED_KEY] for record in records if messages.ELAPSED_KEY in record]
+        if not elapsed:
+            return
+
+        sizer = self.batch_sizers[task.task_type]
+        sizer.observe(sum(elapsed), len(elapsed))
+        batch_size = sizer.batch_size(task.batch_size)
+        if batch_size != task.batch_size:
+            logger.debug('Resizing batches of task type %s from %d to %d items', task.task_type, task.batch_size, batch_size)
+            task.batch_size = batch_size
+
+
+    def complete_in_flight(self, task_type, records):
+        """
+        Stops tracking the ACKed items.
+
+        :return list: The records of items in flight or waiting to be redelivered, leaving out items already ACKed
+        """
+        now = time.time()
+        sent_at = self.sent_at[task_type]
+        redelivered = self.redelivered[task_type]
+        completed = []
+        for record in records:
+            item_id = record.get('_item_id')
+            address = self.item_workers.pop((task_type, item_id), None)
+            if address is None:
+                if item_id in redelivered and self.take_back_redelivered(task_type, item_id):
+                    # ACKed by an evicted worker that turned out to be alive, before the item was sent again
+                    completed.append(record)
+                else:
+                    logger.debug('Ignoring ACK of item %s - task type %s - which is not in flight', item_id, task_type)
+                continue
+
+            redelivered.discard(item_id)
+
+            self.in_flight[address].pop(item_id, None)
+            t = sent_at.pop(item_id, None)
+            if self.speculations.pop((task_type, item_id), None) is None and t is not None:
+                # speculated items would skew the latency of regular items
+                self.latencies[task_type].append(now - t)
+            completed.append(record)
+        return completed
+
+
+    def take_back_redelivered(self, task_type, item_id):
+        """
+        Removes an item handed back by an evicted worker from its task's backlog, as long as it wasn't sent again.
+
+        :return bool: Whether the item was removed
+        """
+        self.redelivered[task_type].discard(item_id)
+        task = self.tasks[task_type]
+        for item in task.backlog:
+            if item.get('_item_id') == item_id:
+                task.backlog.remove(item)
+                task.n_sent += 1
+                return True
+        return False
+
+
+    def receive_heartbeats(self):
+        """
+        Reads every heartbeat pending from workers without blocking.
+        """
+        now = time.time()
+        while True:
+            try:
+                msg = self.heartbeat_receiver.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+
+            address, tt, msgtype = messages.get(msg)
+            if msgtype != messages.MESSAGE_TYPE_HEARTBEAT or tt not in self.tasks:
+                continue
+            if address not in self.last_heartbeat:
+                logger.info('Receiving heartbeats from worker %s - task type %s', address, tt)
+            self.last_heartbeat[address] = now
+            self.worker_tasks[address] = tt
+
+
+    def expire_workers(self):
+        """
+        Evicts workers that haven't sent a heartbeat within the heartbeat timeout.
+        """
+        now = time.time()
+        if now < self.next_expiry_check:
+            return
+        self.next_expiry_check = now + self.heartbeat_timeout / 2.0
+
+        for address, last in self.last_heartbeat.items():
+            if now - last > self.heartbeat_timeout:
+                logger.warning('Worker %s sent no heartbeat for %.1f seconds - evicting it', address, now - last)
+                self.evict_worker(address)
+
+
+    def evict_worker(self, address):
+        """
+        Forgets a worker, handing the items in flight on it back to its task to be redelivered to other workers.
+        """
+        self.last_heartbeat.pop(address, None)
+        self.revoking.pop(address, None)
+        if self.worker_initialized.get(address):
+            self.evicted_workers.add(address)
+        self.credits.pop(address, None)
+        self.credit_workers.discard(address)
+        task_type = self.worker_tasks.pop(address, None)
+        items = self.in_flight.pop(address, {})
+        if task_type is None:
+            return
+
+        self.client_addresses.get(task_type, set()).discard(address)
+        if address in self.waiting_workers[task_type]:
+            self.waiting_workers[task_type].remove(address)
+        if address in self.pending_inits[task_type]:
+            self.pending_inits[task_type].remove(address)
+
+        # speculative copies running on the worker are simply forgotten
+        for key, spec_address in self.speculations.items():
+            if spec_address == address:
+                del self.speculations[key]
+
+        task = self.tasks[task_type]
+        if task_type in self.rings:
+            self.remove_routed_worker(task, address)
+
+        redeliver = []
+        for item_id, item in items.items():
+            key = (task_type, item_id)
+            spec_address = self.speculations.pop(key, None)
+            if spec_address is not None:
+                # the speculative copy takes over
+                self.item_workers[key] = spec_address
+                self.in_flight[spec_address][item_id] = item
+            else:
+                self.item_workers.pop(key, None)
+                self.sent_at[task_type].pop(item_id, None)
+                self.redelivered[task_type].add(item_id)
+                redeliver.append(item)
+
+        if redeliver:
+            logger.warning('Redelivering %d items of worker %s - task type %s', len(redeliver), address, task_type)
+            task.n_sent -= len(redeliver)
+            task.backlog.extendleft(redeliver)
+        self.service_task(task)
+
+
+    def median_latency(self, task_type):
+        """
+        :return float: The median time between sending an item of the task and receiving its ACK, or None without enough samples
+        """
+        latencies = self.latencies[task_type]
+        if len(latencies) < 5:
+            return None
+        return sorted(latencies)[len(latencies) // 2]
+
+
+    def speculate(self):
+        """
+        Sends speculative copies of straggling items to idle workers, once few items of a task remain. Whichever
+        copy is ACKed first wins, the collector drops the other.
+        """
+        now = time.time()
+        if now < self.next_speculation_check:
+            return
+        self.next_speculation_check = now + 0.1
+
+        for task_type in self.active_tasks:
+            task = self.tasks[task_type]
+            waiting = self.waiting_workers[task_type]
+            if not waiting or not task.source_exhausted or task.backlog or task.n_routed or task.deadline_heap:
+                continue
+            if task.n_sent - task.n_acks >= self.speculation_threshold:
+                continue
+
+            median = self.median_latency(task_type)
+            if median is None:
+                continue
+
+            cutoff = now - median * self.speculation_factor
+            stragglers = sorted((t, item_id) for item_id, t in self.sent_at[task_type].items()
+                                if t < cutoff and (task_type, item_id) not in self.speculations)
+            for t, item_id in stragglers:
+                if not self.send_speculative_copy(task, item_id):
+                    break
+
+
+    def is_idle(self, address):
+        """
+        :return bool: True if the worker has no items in flight, including speculative copies. Workers holding
+            credits in credit mode can still be busy with the items queued on them
+        """
+        return not self.in_flight.get(address) and address not in self.speculations.values()
+
+
+    def send_speculative_copy(self, task, item_id):
+        """
+        Sends a copy of an in-flight item to an idle worker other than the one running it.
+
+        :return bool: False if no idle worker was available
+        """
+        key = (task.task_type, item_id)
+        address = self.item_workers[key]
+        waiting = self.waiting_workers[task.task_type]
+        candidates = [a for a in waiting if a != address and self.is_idle(a)]
+        if not candidates:
+            return False
+
+        spec_address = candidates[0]
+        waiting.remove(spec_address)
+        item = self.in_flight[address][item_id]
+        logger.info('Sending speculative copy of straggling item %s - task type %s - to worker %s', item_id, task.task_type, spec_address)
+        if task.batch_size == 1:
+            msg = messages.create_data(task.task_type, item)
         else:
-            self.ack_data = {}
+            msg = messages.create_batch(task.task_type, [item])
+        task.client.send_multipart([spec_address, b'', msg])
+        self.speculations[key] = spec_address
+
+        self.credits[spec_address] -= 1
+        if self.credits[spec_address] > 0:
+            waiting.append(spec_address)
+        return True
+
+
+    def steal(self):
+        """
+        Once a task has no items left to send while some of its workers are idle, revokes half the items in flight
+        on its busiest credit mode worker. The worker hands back those it hasn't started, to be sent to the idle workers.
+        """
+        now = time.time()
+        for task_type in self.active_tasks:
+            task = self.tasks[task_type]
+            waiting = self.waiting_workers[task_type]
+            if not waiting or not task.source_exhausted or task.backlog or task.n_routed or task.deadline_heap:
+                continue
+            # routed items must stay on the worker owning their key
+            if task_type in self.rings:
+                continue
+            if not any(self.is_idle(address) for address in waiting):
+                continue
+
+            busiest = None
+            for address in self.client_addresses.get(task_type, ()):
+                if address not in self.credit_workers or now - self.revoking.get(address, 0) < 1.0:
+                    continue
+                if len(self.in_flight.get(address, ())) >= 2 and \
+                        (busiest is None or len(self.in_flight[address]) > len(self.in_flight[busiest])):
+                    busiest = address
+            if busiest is None:
+                continue
+
+            # the items sent last are the least likely to have been started
+            sent_at = self.sent_at[task_type]
+            item_ids = [item_id for item_id in self.in_flight[busiest] if (task_type, item_id) not in self.speculations]
+            item_ids.sort(key = lambda item_id: sent_at.get(item_id, 0))
+            item_ids = item_ids[len(item_ids) - len(self.in_flight[busiest]) // 2:]
+            if not item_ids:
+                continue
+
+            logger.debug('Revoking %d items of worker %s - task type %s', len(item_ids), busiest, task_type)
+            task.client.send_multipart([busiest, b'', messages.create_revoke(task_type, item_ids)])
+            self.revoking[busiest] = now
+
+
+    def take_back(self, task, address, data):
+        """
+        Hands items a worker gave up in answer to REVOKE back to their task, to be sent to other workers.
+        """
+        self.revoking.pop(address, None)
+        task_type = task.task_type
+        in_flight = self.in_flight[address]
+        items = []
+        for item_id in data.get('items', []):
+            item = in_flight.pop(item_id, None)
+            if item is None:
+                continue
+            self.item_workers.pop((task_type, item_id), None)
+            self.sent_at[task_type].pop(item_id, None)
+            items.append(item)
+
+        if items:
+            logger.info('Took back %d items from worker %s - task type %s', len(items), address, task_type)
+            task.n_sent -= len(items)
+            task.backlog.extendleft(reversed(items))
+
+        # the messages given up free up the worker's credits
+        self.add_credits(task_type, address, data.get('n_messages', 0))
 
 
     def register_task_instance(self, taskcls):
         task = taskcls()
         logger.debug('Registering Task with type %s', task.task_type)
 
-        logger.info('Connecting task type %s to endpoint %s', task.task_type, task.endpoint)
+        # tasks streaming their dependencies take their items from their backlog
+        streams_items = taskcls.items.__func__ is not Task.items.__func__ or task.stream_dependencies
+        if not streams_items and taskcls.handle.__func__ is Task.handle.__func__:
+            raise TypeError('Task type %s must implement either handle() or items()' % task.task_type)
+        if not streams_items and (task.routing_key is not None or task.deadline_buffer):
+            # items pulled ahead would be lost once the task sets is_complete itself
+            raise TypeError('Task type %s must produce its items from items() or its dependencies '
+                            'to set routing_key or deadline_buffer' % task.task_type)
+        if not streams_items and (self.speculation_threshold is not None or self.work_stealing):
+            logger.warning('Task type %s produces its work from handle() and never runs out of items - '
+                           'its items are neither speculatively re-executed nor stolen', task.task_type)
+        if task.weight <= 0:
+            raise ValueError('Task weight must be positive')
+        if task.max_in_flight is not None and task.max_in_flight < 1:
+            raise ValueError('Task max_in_flight must be a positive integer')
+        if task.routing_key is not None:
+            self.rings[task.task_type] = HashRing()
+        if task.rate_limit:
+            self.buckets[task.task_type] = TokenBucket(task.rate_limit, task.rate_burst)
+        if task.max_batch_size:
+            self.batch_sizers[task.task_type] = BatchSizer(task.max_batch_size, task.target_message_rate,
+                                                           task.batch_latency_budget)
+
+        task.shard_index = self.shard_index
+        task.n_shards = self.n_shards
+        task.ack_history = self.ack_history
+        if self.journal_dir:
+            task.journal = Journal(os.path.join(self.journal_dir, '%s-%d.journal' % (task.task_type, self.shard_index)))
+
+        endpoint = self.shard_endpoint(task.endpoint)
+        logger.info('Connecting task type %s to endpoint %s', task.task_type, endpoint)
         s = self.context.socket(zmq.ROUTER)
-        s.bind(helpers.endpoint_binding(task.endpoint))
+        s.bind(helpers.endpoint_binding(endpoint))
 
         task.client = s
         self.clients[task.task_type] = s
         self.tasks[task.task_type] = task
+        self.socket_tasks[s] = task
 
         logger.debug('Registering task %s', task.task_type)
         Task.register_task_instance(task)
         self.poller.register(s, zmq.POLLIN)
 
 
+    def build_dependency_graph(self):
+        """
+        Builds the graph of task dependencies once, after all tasks are registered. Each task counts
+        its unmet dependencies, which are decremented as tasks complete, so readiness never has to be
+        recomputed while the distributor is running.
+
+        :raises ValueError: If the dependencies contain a cycle
+        """
+        for task_type, task in self.tasks.items():
+            deps = set(task.dependencies)
+            for dep in deps - set(self.tasks):
+                logger.warning('Task type %s depends on unregistered task type %s - ignoring', task_type, dep)
+
+            deps &= set(self.tasks)
+            self.n_unmet_dependencies[task_type] = len(deps)
+            for dep in deps:
+                self.dependents[dep].append(task_type)
+                if task.stream_dependencies:
+                    self.stream_dependents[dep].append(task_type)
+
+        # topological sort - anything left unvisited is part of a cycle
+        n_unmet = dict(self.n_unmet_dependencies)
+        queue = [tt for tt, n in n_unmet.items() if n == 0]
+        while queue:
+            for dependent_type in self.dependents[queue.pop()]:
+                n_unmet[dependent_type] -= 1
+                if n_unmet[dependent_type] == 0:
+                    queue.append(dependent_type)
+
+        cycle = sorted(tt for tt, n in n_unmet.items() if n > 0)
+        if cycle:
+            raise ValueError('Task dependencies contain a cycle between task types: %s' % ', '.join(cycle))
+
+        self.n_incomplete = len(self.tasks)
+        for task_type, n in self.n_unmet_dependencies.items():
+            task = self.tasks[task_type]
+            if task.stream_dependencies:
+                # streaming tasks run alongside their dependencies, until all of them complete
+                task.source_exhausted = n == 0
+                self.activate_task(task)
+            elif n == 0:
+                self.activate_task(task)
+
+
+    def activate_task(self, task):
+        logger.info('Task type %s is ready for processing', task.task_type)
+        self.active_tasks.add(task.task_type)
+        self.service_task(task)
+
+
+    def check_completion(self, task):
+        """
+        Retires a task that has just completed and activates the dependents it was the last
+        unmet dependency of.
+        """
+        task_type = task.task_type
+        if not task.is_complete or task_type not in self.active_tasks:
+            return
+
+        logger.info('Task type %s is complete', task_type)
+        if task.n_expired:
+            logger.warning('%d items of task type %s expired past their deadline', task.n_expired, task_type)
+        if task.journal:
+            task.journal.sync()
+        self.active_tasks.discard(task_type)
+        self.blocked_tasks.discard(task_type)
+        self.n_incomplete -= 1
+
+        for dependent_type in self.dependents[task_type]:
+            self.n_unmet_dependencies[dependent_type] -= 1
+            if self.n_unmet_dependencies[dependent_type] == 0:
+                dependent = self.tasks[dependent_type]
+                if dependent.stream_dependencies:
+                    # no more items will stream in from its dependencies
+                    dependent.source_exhausted = True
+                    dependent.update_is_complete()
+                    self.service_task(dependent)
+                else:
+                    self.activate_task(dependent)
+
+
     def add_client_address(self, task_type, addr):
         if task_type not in self.client_addresses:
             self.client_addresses[task_type] = set()
@@ -151,106 +779,485 @@ class Distributor(object):
         self.client_addresses[task_type].add(addr)
 
 
-    def run(self):
-        """
-        Runs the distributor and blocks. Call this immediately after instantiating the distributor.
+    def add_credits(self, task_type, address, n):
+        if n > 0 and self.credits.get(address, 0) <= 0:
+            self.waiting_workers[task_type].append(address)
 
-        Since this method will block the calling program, it should be the last thing the calling code
-        does before exiting. Run() will automatically shutdown the distributor gracefully when finished.
+        self.credits[address] = self.credits.get(address, 0) + n
+        logger.debug('Worker %s has %d credits', address, self.credits[address])
 
-        :return: None
-        """
-        logger.info('Distributor is running (main loop processing)')
 
+    def receive_worker_messages(self, task):
+        """
+        Reads every message pending on the task's socket without blocking. Init requests are held until
+        the task is ready for initialization; READY and CREDIT messages grant the worker credits.
+        """
+        task_type = task.task_type
         while True:
             try:
-                socks = dict(self.poller.poll())
-            except KeyboardInterrupt:
+                address, empty, msg = task.client.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
                 break
 
-            if self.sink_ack in socks:
-                self.process_sink_ack()
+            self.add_client_address(task_type, address)
+            self.worker_tasks[address] = task_type
+            if address in self.last_heartbeat:
+                # any message is as good as a heartbeat
+                self.last_heartbeat[address] = time.time()
 
-            alltasks = self.tasks.values()
-            if all([t.is_complete for t in alltasks]):
-                "exit main loop if all registered tasks are complete"
-                logger.info('All tasks complete - exiting distributor main loop')
+            if not self.worker_initialized.get(address):
+                logger.debug('Initial signal for task %s from worker %s recieved', task_type, address)
+                self.pending_inits[task_type].append(address)
+                continue
+
+            if address in self.evicted_workers:
+                logger.warning('Evicted worker %s - task type %s - is alive, resuming it', address, task_type)
+                self.evicted_workers.remove(address)
+                if task_type in self.rings:
+                    self.add_routed_worker(task, address)
+
+            data, tt, msgtype = messages.get(msg)
+            if msgtype == messages.MESSAGE_TYPE_READY:
+                # lockstep workers hold exactly one credit per READY
+                self.add_credits(task_type, address, 1)
+
+            elif msgtype == messages.MESSAGE_TYPE_CREDIT:
+                self.credit_workers.add(address)
+                self.add_credits(task_type, address, data or 0)
+
+            elif msgtype == messages.MESSAGE_TYPE_REVOKE:
+                self.take_back(task, address, data or {})
+
+
+    def initialize_workers(self, task):
+        """
+        Replies to held init requests once the task's dependencies are complete.
+        """
+        pending = self.pending_inits[task.task_type]
+        if not pending:
+            return
+
+        for address in pending:
+            self.worker_initialized[address] = True
+            task.received_init_signal = True
+
+            if hasattr(task, 'initialize'):
+                logger.info('Initializing task type %s', task.task_type)
+                task.initialize(metadata = self.metadata)
+
+            logger.debug('Sending success reply to worker address: %s', address)
+            task.client.send_multipart([
+                address, b'', messages.create_metadata(self.metadata)
+            ])
+
+            if task.task_type in self.rings:
+                self.add_routed_worker(task, address)
+        del pending[:]
+
+
+    def add_routed_worker(self, task, address):
+        """
+        Adds a worker to the hash ring of a task routing items by key, and re-routes the items waiting for a worker,
+        some of which the new worker now owns.
+        """
+        logger.info('Routing items of task type %s to worker %s', task.task_type, address)
+        self.rings[task.task_type].add(address)
+
+        routed = self.routed[task.task_type]
+        items = []
+        for queue in routed.values():
+            items.extend(queue)
+            queue.clear()
+        for item in items:
+            self.route_item(task, item, address)
+
+
+    def remove_routed_worker(self, task, address):
+        """
+        Removes a worker from the hash ring of a task routing items by key. The items that were waiting for it
+        go back to the task's backlog to be routed again.
+        """
+        self.rings[task.task_type].remove(address)
+        queue = self.routed[task.task_type].pop(address, None)
+        if queue:
+            task.n_routed -= len(queue)
+            task.backlog.extendleft(reversed(queue))
+
+
+    def route_item(self, task, item, address):
+        """
+        Queues an item for the worker owning its routing key, or for the worker at address if the item has no key.
+        """
+        key = item.get(task.routing_key)
+        owner = address if key is None else self.rings[task.task_type].get(key)
+        self.routed[task.task_type][owner].append(item)
+
+
+    def take_items(self, task, address):
+        """
+        Invokes the task's handler for the next items to send.
+
+        :return list: The items, or an empty list if the task had nothing to send
+        """
+        data = {}
+
+        items = []
+        while not items:
+            # invoke registered task's handler
+            logger.debug('Invoking task.handle_batch for task type: %s, client address %s', task.task_type, address)
+            items = task.handle_batch(data, address, messages.MESSAGE_TYPE_READY, self.ack_data)
+            if not isinstance(items, list):
+                raise TypeError('Task batch handler must return a list')
+            if not items:
+                task.update_is_complete()
+                return []
+
+            for i, sdata in enumerate(items):
+                if not isinstance(sdata, dict) and sdata is not None:
+                    raise TypeError('Task handler must return a dictionary or nothing')
+                items[i] = sdata = sdata or {}
+                if '_item_id' not in sdata:
+                    sdata['_item_id'] = task.next_item_id()
+                if self.n_shards > 1:
+                    sdata['_shard'] = self.shard_index
+
+            if task.journal:
+                # items done in a previous run are skipped
+                items = [sdata for sdata in items if not task.journal.is_done(sdata['_item_id'])]
+        return items
+
+
+    def take_routed_items(self, task, address):
+        """
+        Takes the next items routed to a worker, pulling and routing more items from the task until the worker has
+        a full batch or routing_buffer items are waiting for workers.
+
+        :return list: The items, or an empty list if none are routed to the worker
+        """
+        queue = self.routed[task.task_type][address]
+        while len(queue) < task.batch_size and task.n_routed < task.routing_buffer:
+            items = self.take_items(task, address)
+            if not items:
                 break
+            for sdata in items:
+                self.route_item(task, sdata, address)
+            task.n_routed += len(items)
 
-            for task_type, task in self.tasks.items():
-                if task.is_complete:
-                    # task finished - skip
-                    continue
+        items = []
+        while queue and len(items) < task.batch_size:
+            items.append(queue.popleft())
+        task.n_routed -= len(items)
+        return items
+
+
+    def send_work(self, task, address):
+        """
+        Takes the task's next items for the worker and sends them to it as a single message.
+
+        :return int: The number of items sent, zero if the task had nothing to send
+        """
+        if task.task_type in self.rings:
+            items = self.take_routed_items(task, address)
+        else:
+            items = self.take_items(task, address)
+        if not items:
+            return 0
+
+        logger.debug('Sending %d items to worker - task type: %s - data: %s', len(items), task.task_type, items)
+        if task.batch_size == 1 and len(items) == 1:
+            msg = messages.create_data(task.task_type, items[0])
+        else:
+            msg = messages.create_batch(task.task_type, items)
+
+        task.client.send_multipart([address, b'', msg])
+        task.n_sent += len(items)
+        if self.track_in_flight:
+            now = time.time()
+            in_flight = self.in_flight[address]
+            sent_at = self.sent_at[task.task_type]
+            for sdata in items:
+                in_flight[sdata['_item_id']] = sdata
+                sent_at[sdata['_item_id']] = now
+                self.item_workers[(task.task_type, sdata['_item_id'])] = address
+        if task.journal:
+            task.journal.record_dispatched([sdata['_item_id'] for sdata in items])
+        return len(items)
+
+
+    def dispatch(self, task):
+        """
+        Sends a single message to the task's next waiting worker. Never blocks.
 
-                if task.is_task_ready_for_initialization() or task.received_init_signal:
-                    # task either needs to be initialized, or has been initialized and is ready for processing
+        :return int: The number of items sent, zero if the task can't be dispatched to right now
+        """
+        waiting = self.waiting_workers[task.task_type]
+        if not waiting or task.is_complete:
+            return 0
+
+        # tasks at their in-flight cap are serviced again as ACKs arrive
+        if task.max_in_flight and task.n_sent - task.n_acks >= task.max_in_flight:
+            self.blocked_tasks.add(task.task_type)
+            return 0
+
+        if not task.is_available_for_handling(self.ack_data):
+            self.blocked_tasks.add(task.task_type)
+            return 0
+        self.blocked_tasks.discard(task.task_type)
+
+        # rate limited tasks are serviced again once a token is available
+        bucket = self.buckets.get(task.task_type)
+        if bucket:
+            wait = bucket.wait_time()
+            if wait > 0:
+                self.throttled[task.task_type] = time.time() + wait
+                return 0
+
+        if task.task_type in self.rings:
+            # the next waiting worker may have no items routed to it while others do
+            for _ in range(len(waiting)):
+                address = waiting.popleft()
+                n = self.send_work(task, address)
+                if n:
+                    break
+                waiting.append(address)
+            else:
+                return 0
+        else:
+            address = waiting.popleft()
+            n = self.send_work(task, address)
+            if not n:
+                waiting.appendleft(address)
+                return 0
 
-                    if task.received_init_signal and not task.is_available_for_handling(self.ack_data):
-                        # only consult the task about handling availability if the init signal has been received
-                        continue
+        if bucket:
+            bucket.take(n)
 
-                    address, empty, msg = task.client.recv_multipart()
-                    self.add_client_address(task_type, address)
+        self.credits[address] -= 1
+        if self.credits[address] > 0:
+            waiting.append(address)
+        return n
 
-                    if not self.worker_initialized.get(address):
-                        logger.debug('Initial signal for task %s from worker %s recieved', task_type, address)
-                        self.worker_initialized[address] = True
-                        task.received_init_signal = True
 
-                        if hasattr(task, 'initialize'):
-                            logger.info('Initializing task type %s', task.task_type)
-                            task.initialize(metadata = self.metadata)
+    def service_task(self, task):
+        """
+        Initializes held workers of an active task and schedules it to be dispatched to.
+        """
+        if task.task_type not in self.active_tasks:
+            return
 
-                        logger.debug('Sending success reply to worker address: %s', address)
-                        task.client.send_multipart([
-                            address, b'', messages.create_metadata(self.metadata)
-                        ])
+        self.initialize_workers(task)
+        self.scheduler.add(task)
 
-                    else:
-                        data, tt, msgtype = messages.get(msg)
-                        data = data or {}
 
-                        if msgtype == messages.MESSAGE_TYPE_READY:
-                            # invoke registered task's handler
-                            logger.debug('Invoking task.handle for task type: %s, client address %s - passing data: %s', task.task_type, address, data)
-                            sdata = task.handle(data, address, msgtype, self.ack_data) or {}
-                            if not isinstance(sdata, dict) and sdata is not None:
-                                raise TypeError('Task handler must return a dictionary or nothing')
+    def run_scheduler(self):
+        """
+        Dispatches to scheduled tasks one message at a time, in the order decided by the scheduler, until none
+        of them can be dispatched to or dispatch_quantum messages were sent. Tasks still scheduled are dispatched
+        to in the next pass, so when the distributor is saturated the scheduler decides which tasks are served.
+
+        :return bool: True if tasks are still scheduled
+        """
+        for _ in range(self.dispatch_quantum):
+            task = self.scheduler.pop()
+            if task is None:
+                return False
 
-                            sdata.update(data)
+            n = self.dispatch(task)
+            if n:
+                self.scheduler.charge(task, n)
+                self.scheduler.add(task)
+            self.check_completion(task)
+        return len(self.scheduler) > 0
 
-                            logger.debug('Sending to collector - task type: %s - data: %s', tt, sdata)
-                            task.client.send_multipart([
-                                address, b'', messages.create_data(tt, sdata)
-                            ])
+
+    def sync_journals(self):
+        """
+        Fsyncs task journals with records that have waited on an fsync for longer than their sync interval.
+        """
+        for task in self.tasks.values():
+            if task.journal:
+                task.journal.sync_if_due()
+
+
+    def poll_timeout(self, timeout):
+        """
+        :param timeout: The longest time to wait for in milliseconds, or None to wait indefinitely
+        :return: The time to wait for in milliseconds, shortened to wake up when the first throttled task gets a token,
+            or zero while tasks are left scheduled
+        """
+        if self.scheduler:
+            return 0
+        if not self.throttled:
+            return timeout
+
+        wait = max(0, (min(self.throttled.values()) - time.time()) * 1000)
+        return wait if timeout is None else min(timeout, wait)
+
+
+    def release_throttled(self):
+        """
+        Schedules the rate limited tasks that can be dispatched to again.
+        """
+        now = time.time()
+        for task_type, t in self.throttled.items():
+            if t <= now:
+                del self.throttled[task_type]
+                self.service_task(self.tasks[task_type])
+
+
+    def expired_counts(self):
+        """
+        Returns the number of items of each task that expired past their deadline, see Task.deadline_buffer.
+
+        :return dict: Numbers of items, keyed on task type
+        """
+        return dict((task_type, task.n_expired) for task_type, task in self.tasks.items())
+
+
+    def dispatch_rates(self):
+        """
+        Returns the rate at which items have recently been dispatched to each task.
+
+        :return dict: Items per second, keyed on task type
+        """
+        return self.scheduler.dispatch_rates()
+
+
+    def run(self):
+        """
+        Runs the distributor and blocks. Call this immediately after instantiating the distributor.
+
+        Since this method will block the calling program, it should be the last thing the calling code
+        does before exiting. Run() will automatically shutdown the distributor gracefully when finished.
+
+        :return: None
+        """
+        logger.info('Distributor is running (main loop processing)')
+        self.run_scheduler()
+
+        # wake up regularly to expire workers that stopped sending heartbeats and look for stragglers
+        timeout = None
+        if self.heartbeat_receiver is not None:
+            timeout = self.heartbeat_timeout * 500
+        if self.speculation_threshold is not None:
+            timeout = min(timeout or 100, 100)
+
+        while True:
+            try:
+                socks = dict(self.poller.poll(self.poll_timeout(timeout)))
+            except KeyboardInterrupt:
+                break
+
+            if self.sink_ack in socks:
+                self.receive_acks()
+
+            if self.heartbeat_receiver is not None:
+                if self.heartbeat_receiver in socks:
+                    self.receive_heartbeats()
+                self.expire_workers()
+
+            if self.throttled:
+                self.release_throttled()
+
+            # only service sockets the poller reported as readable
+            for sock in socks:
+                task = self.socket_tasks.get(sock)
+                if task is not None:
+                    self.receive_worker_messages(task)
+                    self.service_task(task)
+
+            self.run_scheduler()
+            if self.speculation_threshold is not None:
+                self.speculate()
+            if self.work_stealing:
+                self.steal()
+            self.sync_journals()
+
+            if not self.n_incomplete:
+                "exit main loop if all registered tasks are complete"
+                logger.info('All tasks complete - exiting distributor main loop')
+                break
 
         # shutdown collector + workers
         self.shutdown()
 
 
-    def shutdown(self):
+    def shutdown(self, timeout = None):
         """
         Shuts down the distributor. This is automatically called when run() is complete and the distributor
         exits gracefully. Client code should only invoke this method directly on exiting prematurely,
         for example on a KeyboardInterruptException
 
+        END is sent right away to every worker waiting on the distributor, and to all other workers of all tasks
+        as soon as they next send a message, until every worker has been sent END or the timeout expires.
+
+        :param float timeout: The longest time to wait for workers in seconds. Defaults to the shutdown_timeout given at instantiation
         :return: None
         """
+        timeout = self.shutdown_timeout if timeout is None else timeout
         logger.info('Shutting down collector and workers')
 
+        for task in self.tasks.values():
+            if task.journal:
+                task.journal.close()
+
         logger.debug('Sending END signal to collector')
         self.sink.send(messages.create_end())
 
+        remaining = {}
+        for task_type, task in self.tasks.items():
+            client_addrs = set(self.client_addresses.get(task_type, ()))
+            logger.debug('Shutting down %d clients for task type %s', len(client_addrs), task_type)
+
+            # workers holding credits or waiting on init are already waiting on us, and credit mode
+            # workers can receive END at any time
+            waiting = set(self.waiting_workers[task_type]) | set(self.pending_inits[task_type])
+            waiting |= client_addrs & self.credit_workers
+            for address in waiting:
+                self.send_end(task, address)
+            remaining[task_type] = client_addrs - waiting
+
+        poller = zmq.Poller()
         for task_type, task in self.tasks.items():
-            client_addrs = self.client_addresses[task_type]
-            n_clients = len(client_addrs)
+            poller.register(task.client, zmq.POLLIN)
+
+        deadline = time.time() + timeout
+        while any(remaining.values()):
+            wait = deadline - time.time()
+            if wait <= 0:
+                logger.warning('Timed out waiting for %d workers to shut down', sum(len(a) for a in remaining.values()))
+                break
+
+            for sock in dict(poller.poll(wait * 1000)):
+                task = self.socket_tasks[sock]
+                while True:
+                    try:
+                        address, empty, msg = sock.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+
+                    addrs = remaining[task.task_type]
+                    if address in addrs or address not in self.client_addresses.get(task.task_type, ()):
+                        # late joiners are sent END too, credits returned after END are ignored
+                        self.send_end(task, address)
+                        addrs.discard(address)
+
+        self.close(linger = 1000)
 
-            logger.debug('Shutting down %d clients for task type %s', n_clients, task_type)
-            for _ in client_addrs:
-                address, empty, msg = task.client.recv_multipart()
 
-                logger.debug('Sending END signal to worker address %s - task type %s', address, task_type)
-                task.client.send_multipart([
-                    address, b'', messages.create_end(task = task_type)
-                ])
+    def send_end(self, task, address):
+        logger.debug('Sending END signal to worker address %s - task type %s', address, task.task_type)
+        task.client.send_multipart([
+            address, b'', messages.create_end(task = task.task_type)
+        ])
 
+
+    def close(self, linger = 0):
+        """
+        Closes all sockets, waiting up to linger milliseconds for queued messages to be sent.
+        """
+        sockets = [self.sink, self.sink_ack, self.metadata_client, self.heartbeat_receiver]
+        sockets += [task.client for task in self.tasks.values()]
+        for sock in sockets:
+            if sock is not None and not sock.closed:
+                sock.close(linger = linger)
@@ -1,3 +1,4 @@
+import os
 from urlparse import urlparse
 
 
@@ -33,3 +34,20 @@ def endpoint_binding(addr):
     else:
         return addr
 
+
+
+def shard_endpoint(addr, index):
+    """
+    Returns the endpoint used by the given shard when running several sharded distributors. Shard 0 uses the
+    endpoint unchanged; other shards offset tcp ports by their index and suffix ipc and inproc names with it.
+    """
+    if not index:
+        return addr
+
+    parsed = urlparse(addr)
+    if parsed.scheme == 'tcp':
+        host, port = parsed.netloc.split(':')
+        return 'tcp://%s:%d' % (host, int(port) + index)
+    else:
+        root, ext = os.path.splitext(addr)
+        return '%s-%d%s' % (root, index, ext)
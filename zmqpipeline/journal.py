@@ -0,0 +1,159 @@
+import logging
+import os
+import struct
+import time
+
+import msgpack
+
+logger = logging.getLogger('zmqpipeline.journal')
+
+
+class Journal(object):
+    """
+    An append-only journal of the item ids a task has dispatched and that the collector has ACKed, so a restarted
+    distributor can skip the items that are already done.
+
+    Each record is a msgpack encoded (kind, item id) pair prefixed with its length. ACK records of tasks that other
+    tasks stream their dependencies from also carry the ACKed item, from which the streaming tasks' items are produced
+    again on resume. Writes are buffered and fsynced in batches, every sync_every records or sync_interval seconds,
+    whichever comes first. A record torn by a crash is discarded when the journal is reopened.
+    """
+    DISPATCHED = 'D'
+    ACKED = 'A'
+
+    header = struct.Struct('<I')
+
+    def __init__(self, path, sync_every = 1000, sync_interval = 1.0):
+        """
+        Opens the journal at path, creating it if it doesn't exist, and replays its records.
+
+        :param str path: The path of the journal file
+        :param int sync_every: The maximum number of records written between fsyncs
+        :param float sync_interval: The maximum number of seconds between fsyncs while records are being written
+        """
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+
+        # ids ACKed, and ids dispatched but not yet ACKed
+        self.done = set()
+        self.in_flight = set()
+        # the size of the records written by previous runs
+        self.loaded_size = 0
+
+        self.load()
+        self.file = open(path, 'ab')
+        self.n_unsynced = 0
+        self.last_sync = time.time()
+
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, 'rb') as f:
+            buf = f.read()
+
+        offset = 0
+        while offset + self.header.size <= len(buf):
+            size, = self.header.unpack_from(buf, offset)
+            end = offset + self.header.size + size
+            if end > len(buf):
+                break
+            record = msgpack.unpackb(buf[offset + self.header.size:end])
+            self.replay(record[0], record[1])
+            offset = end
+
+        if offset < len(buf):
+            logger.warning('Discarding %d bytes of a torn record at the end of journal %s', len(buf) - offset, self.path)
+            with open(self.path, 'r+b') as f:
+                f.truncate(offset)
+        self.loaded_size = offset
+
+        logger.info('Loaded journal %s - %d items done, %d in flight', self.path, len(self.done), len(self.in_flight))
+
+
+    def replay(self, kind, item_id):
+        if kind == self.ACKED:
+            self.done.add(item_id)
+            self.in_flight.discard(item_id)
+        elif item_id not in self.done:
+            self.in_flight.add(item_id)
+
+
+    def is_done(self, item_id):
+        """
+        :return bool: True if the item has been ACKed, in this run or a previous one
+        """
+        return item_id in self.done
+
+
+    def acked_items(self):
+        """
+        Reads back the ACKed items recorded by previous runs, one record at a time, so they're never all in memory.
+
+        :return: A generator of ACKed items
+        """
+        with open(self.path, 'rb') as f:
+            offset = 0
+            while offset < self.loaded_size:
+                size, = self.header.unpack(f.read(self.header.size))
+                record = msgpack.unpackb(f.read(size))
+                offset += self.header.size + size
+                if record[0] == self.ACKED and len(record) > 2:
+                    yield record[2]
+
+
+    def record_dispatched(self, item_ids):
+        self.write(self.DISPATCHED, item_ids)
+
+
+    def record_acked(self, item_ids, items = None):
+        """
+        :param list item_ids: The ids of the ACKed items
+        :param list items: If given, the ACKed items, to be kept along with their ids
+        """
+        self.write(self.ACKED, item_ids, items)
+
+
+    def write(self, kind, item_ids, items = None):
+        n = 0
+        for i, item_id in enumerate(item_ids):
+            if items is None:
+                record = msgpack.packb((kind, item_id))
+            else:
+                record = msgpack.packb((kind, item_id, items[i]))
+            self.file.write(self.header.pack(len(record)) + record)
+            self.replay(kind, item_id)
+            n += 1
+
+        self.n_unsynced += n
+        if self.n_unsynced >= self.sync_every:
+            self.sync()
+        else:
+            self.sync_if_due()
+
+
+    def sync_if_due(self):
+        """
+        Syncs the journal if records have been waiting on an fsync for longer than sync_interval.
+        """
+        if self.n_unsynced and time.time() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+
+    def sync(self):
+        """
+        Flushes and fsyncs all records written so far.
+        """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.n_unsynced = 0
+        self.last_sync = time.time()
+
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.sync()
+        self.file.close()
@@ -0,0 +1,81 @@
+import logging
+import time
+
+from utils import messages
+
+logger = logging.getLogger('zmqpipeline.result_buffer')
+
+
+class ResultBuffer(object):
+    """
+    Sends the results of a worker to the collector. When max_size is set, results are coalesced into BATCH messages
+    of up to max_size results, flushed at the latest flush_interval seconds after the first result was buffered,
+    so the collector unpacks and ACKs one message for many results.
+
+    Without max_size every result is sent as soon as it is added, as the worker produced it.
+    """
+    def __init__(self, socket, task_type, max_size = None, flush_interval = 0.01):
+        """
+        :param socket: The socket connected to the collector
+        :param TaskType task_type: The task type of the worker
+        :param int max_size: The number of results sent in one message at most, or None to send results unbuffered
+        :param float flush_interval: The number of seconds a result is buffered at most
+        """
+        if max_size is not None and max_size < 1:
+            raise ValueError('max_size must be a positive integer')
+        if flush_interval < 0:
+            raise ValueError('flush_interval must not be negative')
+
+        self.socket = socket
+        self.task_type = task_type
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.results = []
+        self.first_added = None
+
+    def __len__(self):
+        return len(self.results)
+
+    def add(self, msgtype, data):
+        """
+        :param str msgtype: MESSAGE_TYPE_DATA for a single result, or MESSAGE_TYPE_BATCH for a list of results
+        :param data: The result, or list of results
+        """
+        if self.max_size is None:
+            if msgtype == messages.MESSAGE_TYPE_BATCH:
+                self.socket.send(messages.create_batch(self.task_type, data))
+            else:
+                self.socket.send(messages.create_data(self.task_type, data))
+            return
+
+        if not self.results:
+            self.first_added = time.time()
+        if msgtype == messages.MESSAGE_TYPE_BATCH:
+            self.results.extend(data)
+        else:
+            self.results.append(data)
+
+        if len(self.results) >= self.max_size:
+            self.flush()
+
+    def timeout(self):
+        """
+        :return int: The number of milliseconds until the buffer is due to be flushed, or None if it's empty
+        """
+        if not self.results:
+            return None
+        remaining = self.first_added + self.flush_interval - time.time()
+        return max(0, int(remaining * 1000))
+
+    def flush(self):
+        if not self.results:
+            return
+
+        logger.debug('Sending %d buffered results of task type %s', len(self.results), self.task_type)
+        self.socket.send(messages.create_batch(self.task_type, self.results))
+        self.results = []
+        self.first_added = None
+
+    def flush_if_due(self):
+        if self.results and time.time() - self.first_added >= self.flush_interval:
+            self.flush()
@@ -0,0 +1,64 @@
+from bisect import bisect, insort
+import hashlib
+import logging
+
+logger = logging.getLogger('zmqpipeline.routing')
+
+
+def hash_key(key):
+    """
+    :return int: A hash of the key that is stable across processes, unlike hash()
+    """
+    return int(hashlib.md5(str(key)).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """
+    Maps keys to nodes by consistent hashing. When a node joins or leaves only the keys owned by that node move,
+    so every other node keeps seeing the same keys.
+    """
+    def __init__(self, n_replicas = 64):
+        """
+        :param int n_replicas: The number of points each node has on the ring. More points spread keys more evenly
+        """
+        self.n_replicas = n_replicas
+        self.points = []
+        self.owners = {}
+        self.nodes = set()
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, node):
+        return node in self.nodes
+
+    def add(self, node):
+        if node in self.nodes:
+            return
+
+        self.nodes.add(node)
+        for i in range(self.n_replicas):
+            point = hash_key('%s-%d' % (node, i))
+            self.owners[point] = node
+            insort(self.points, point)
+
+    def remove(self, node):
+        if node not in self.nodes:
+            return
+
+        self.nodes.discard(node)
+        for i in range(self.n_replicas):
+            point = hash_key('%s-%d' % (node, i))
+            if self.owners.get(point) == node:
+                del self.owners[point]
+        self.points = [point for point in self.points if point in self.owners]
+
+    def get(self, key):
+        """
+        :return: The node owning the key, or None if the ring has no nodes
+        """
+        if not self.points:
+            return None
+
+        i = bisect(self.points, hash_key(key)) % len(self.points)
+        return self.owners[self.points[i]]
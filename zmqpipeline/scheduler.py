@@ -0,0 +1,189 @@
+from collections import defaultdict, deque
+from heapq import heappush, heappop
+import bisect
+import itertools
+import time
+import logging
+
+logger = logging.getLogger('zmqpipeline.scheduler')
+
+
+class RateMeter(object):
+    """
+    Measures the rate of events over a sliding window of time.
+    """
+    def __init__(self, window = 10.0):
+        self.window = window
+        self.events = deque()
+        self.total = 0
+
+    def add(self, n = 1, now = None):
+        now = time.time() if now is None else now
+        self.events.append((now, n))
+        self.total += n
+        self.expire(now)
+
+    def expire(self, now):
+        while self.events and self.events[0][0] < now - self.window:
+            self.total -= self.events.popleft()[1]
+
+    def rate(self, now = None):
+        """
+        :return float: Events per second over the window
+        """
+        now = time.time() if now is None else now
+        self.expire(now)
+        return self.total / self.window
+
+
+class TokenBucket(object):
+    """
+    Limits the rate of events to rate per second on average, allowing bursts of up to burst events.
+    """
+    def __init__(self, rate, burst = None):
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+
+        self.rate = float(rate)
+        self.burst = float(burst) if burst else max(1.0, self.rate)
+        self.tokens = self.burst
+        self.last = time.time()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def wait_time(self, now = None):
+        """
+        :return float: The number of seconds until an event is allowed, zero if one is allowed now
+        """
+        now = time.time() if now is None else now
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, n = 1, now = None):
+        """
+        Accounts for n events. Taking more tokens than available delays later events accordingly.
+        """
+        now = time.time() if now is None else now
+        self.refill(now)
+        self.tokens -= n
+
+
+
+class Scheduler(object):
+    """
+    Decides the order in which runnable tasks are dispatched to.
+
+    Tasks with a higher priority are served first. Tasks passed over for higher priority tasks still keep min_share
+    of dispatch: each item dispatched to a higher priority task earns every lower priority level with scheduled tasks
+    a fraction of an item, and a level that has earned a whole item is served out of turn. Earnings are kept per
+    priority level, so scheduling costs no more with many tasks than with few.
+
+    Tasks of equal priority share dispatch in proportion to their weights by weighted fair queuing: each task carries
+    a virtual time that advances by the number of items it is sent divided by its weight, and the task with the
+    lowest virtual time is served next.
+    """
+    def __init__(self, rate_window = 10.0, min_share = 0.05):
+        """
+        :param float rate_window: The number of seconds dispatch rates are measured over
+        :param float min_share: The least share of all items dispatched kept by lower priority tasks, zero for strict priorities
+        """
+        if not 0 <= min_share < 1:
+            raise ValueError('min_share must be at least zero and less than one')
+
+        self.rate_window = rate_window
+        self.min_share = min_share
+        # heaps of scheduled tasks, keyed on negated priorities
+        self.levels = defaultdict(list)
+        # negated priorities of the levels with scheduled tasks, highest priority first
+        self.active_levels = []
+        self.scheduled = set()
+        self.virtual_time = {}
+        self.global_time = 0.0
+        # items earned by levels passed over for higher priority levels, keyed on negated priorities
+        self.earned = defaultdict(float)
+        self.out_of_turn = None
+        self.meters = {}
+        self._counter = itertools.count()
+
+    def add(self, task):
+        """
+        Schedules a task to be dispatched to. Tasks already scheduled are ignored.
+        """
+        task_type = task.task_type
+        if task_type in self.scheduled:
+            return
+
+        # an idle task resumes at the current virtual time rather than catching up on its backlog of share
+        start = max(self.virtual_time.get(task_type, 0.0), self.global_time)
+        self.virtual_time[task_type] = start
+        level = -task.priority
+        heap = self.levels[level]
+        if not heap:
+            bisect.insort(self.active_levels, level)
+        heappush(heap, (start, next(self._counter), task))
+        self.scheduled.add(task_type)
+
+    def pop(self):
+        """
+        :return: The next task to dispatch to, or None if no task is scheduled
+        """
+        if not self.active_levels:
+            return None
+
+        top = level = self.active_levels[0]
+        if self.min_share:
+            # a passed over level that has earned a whole item goes first
+            for other in self.active_levels[1:]:
+                if self.earned[other] >= 1 and (level == top or self.earned[other] > self.earned[level]):
+                    level = other
+
+        if level == top:
+            self.out_of_turn = None
+            # no higher priority task is waiting, so the level isn't owed anything
+            self.earned.pop(level, None)
+        else:
+            self.out_of_turn = level
+
+        heap = self.levels[level]
+        start, _, task = heappop(heap)
+        if not heap:
+            self.active_levels.remove(level)
+        self.scheduled.discard(task.task_type)
+        self.global_time = max(self.global_time, start)
+        return task
+
+    def charge(self, task, n_items):
+        """
+        Accounts for n_items dispatched to the task.
+        """
+        task_type = task.task_type
+        self.virtual_time[task_type] = self.virtual_time.get(task_type, self.global_time) + float(n_items) / task.weight
+
+        level = -task.priority
+        if level == self.out_of_turn:
+            self.earned[level] -= n_items
+        elif self.min_share:
+            # items earned per item dispatched, so that lower priority levels get min_share of all items
+            rate = self.min_share / (1 - self.min_share) * n_items
+            for other in self.active_levels:
+                if other > level:
+                    self.earned[other] += rate
+        self.out_of_turn = None
+
+        if task_type not in self.meters:
+            self.meters[task_type] = RateMeter(self.rate_window)
+        self.meters[task_type].add(n_items)
+
+    def __len__(self):
+        return len(self.scheduled)
+
+    def dispatch_rates(self):
+        """
+        :return dict: Items dispatched per second over the rate window, keyed on task type
+        """
+        now = time.time()
+        return dict((task_type, meter.rate(now)) for task_type, meter in self.meters.items())
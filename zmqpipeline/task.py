@@ -1,7 +1,10 @@
-from abc import ABCMeta, abstractproperty, abstractmethod
+from abc import ABCMeta, abstractproperty
 from descriptors import TaskType, EndpointAddress
-from collections import defaultdict
+from collections import defaultdict, deque
+from heapq import heappush, heappop
+import itertools
 import logging
+import time
 
 logger = logging.getLogger('zmqpipeline.task')
 
@@ -37,14 +40,84 @@ class Task(object):
     """
     __metaclass__ = TaskMeta
     n_items = 0
+    batch_size = 1
+    # when set, the distributor adapts batch_size between 1 and max_batch_size to the item service time workers report
+    # in ACKs, aiming for at most target_message_rate messages per second per worker within the latency budget
+    max_batch_size = None
+    target_message_rate = 50.0
+    batch_latency_budget = 1.0
+    priority = 0
+    weight = 1
+    # items per second dispatched at most on average, allowing bursts of up to rate_burst items
+    rate_limit = None
+    rate_burst = None
+    # the most items sent but not yet ACKed at any time
+    max_in_flight = None
+    # when set to the name of an item key, items with the same value for that key are routed to the same worker
+    # by consistent hashing, keeping up to routing_buffer items waiting for the worker they are routed to
+    routing_key = None
+    routing_buffer = 1000
+    n_routed = 0
+    # when set, up to deadline_buffer items are pulled ahead and dispatched earliest _deadline first. Items that
+    # can't be sent deadline_margin seconds before their deadline are expired and passed to handle_expired()
+    deadline_buffer = None
+    deadline_margin = 0.0
+    n_expired = 0
+    shard_index = 0
+    n_shards = 1
     n_acks = 0
     n_sent = 0
+    source_exhausted = False
+    stream_dependencies = False
     received_init_signal = False
     client_addresses = set()
     client = None
+    ack_history = None
+    journal = None
     is_complete = False
     metadata = {}
     task_instances = defaultdict(list)
+    _source = None
+    _source_position = 0
+    _backlog = None
+    _resumed = None
+    _deadline_heap = None
+    _deadline_counter = None
+    _next_id = 0
+
+
+    @property
+    def backlog(self):
+        """
+        Items waiting to be dispatched ahead of items() or handle(), such as items made eligible by
+        streaming dependencies.
+        """
+        if self._backlog is None:
+            self._backlog = deque()
+        return self._backlog
+
+
+    def resume_items(self, items):
+        """
+        Queues items produced again from dependencies ACKed in a previous run, taken lazily ahead of the backlog.
+
+        :param items: An iterable of dictionaries
+        """
+        if self._resumed is None:
+            self._resumed = itertools.chain(items)
+        else:
+            self._resumed = itertools.chain(self._resumed, items)
+
+
+    @property
+    def deadline_heap(self):
+        """
+        Items pulled ahead by tasks with a deadline_buffer, ordered on their deadline.
+        """
+        if self._deadline_heap is None:
+            self._deadline_heap = []
+            self._deadline_counter = itertools.count()
+        return self._deadline_heap
 
 
     def is_available_for_handling(self, last_ack_data):
@@ -52,11 +125,14 @@ class Task(object):
         Optionally override this if the task requires the ACK of a previously sent task.
 
         If this method is overriden, get_ack_data() should be overrridden in your custom collector.
+        Older ACKs can be looked up in self.ack_history, by ACK id with get() or by task type with latest()
+        and for_task(), so a task doesn't have to wait for each ACK in turn.
         The default is to always assume the task is available to process the next task. This is the fastest
         behavior, but also doesn't guarantee the last message sent by the task (and then the corresponding worker)
         has been ACKed by the distributor.
 
-        :param dict last_ack_data: A dictionary of data received in the last ACK. All instances include _task_type and _id, a globally incrementing counter for the latest ACK.
+        :param dict last_ack_data: A dictionary of data received in the last ACK. All instances include _task_type and _id, a globally incrementing counter for the latest ACK,
+            as well as _n_items and _items, a list with the _item_id of each item acknowledged and whatever handle_collection() returned for it.
             This dictionary will include whatever you attach to get_ack_data() in the collector. If you override this method, you should override get_col
         :return: True if the task is available for handling the next received message; false if otherwise
         """
@@ -104,10 +180,89 @@ class Task(object):
         logger.debug('Initializing task with meta data %s', metadata)
         self.metadata = metadata
 
-    @abstractmethod
+    def items(self):
+        """
+        Optionally override this with a generator (or return any iterator) of work items to stream them to the workers.
+        The distributor pulls items lazily, batch_size at a time, so the full list of work is never held in memory.
+
+        A streaming task is marked complete automatically once the iterator is exhausted and every item sent has been
+        ACKed by the collector, and doesn't need to implement handle().
+
+        :return: An iterable of dictionaries, or None (the default) if work is produced by handle()
+        """
+        return None
+
+    def items_from_dependency(self, task_type, ack_item):
+        """
+        Invoked on tasks with stream_dependencies turned on whenever the collector ACKs an item of one of the
+        task's dependencies. The returned items are eligible for dispatch right away, so both tasks run
+        overlapped instead of back-to-back.
+
+        The default implementation forwards the ACKed item as a single work item, keyed on the upstream item
+        by the _dependency_item_id key. Items without an _item_id are given one derived from the ACKed item, so
+        they keep their ids across runs of a journaled distributor.
+
+        :param TaskType task_type: The task type of the dependency
+        :param dict ack_item: The ACKed item: its _item_id and whatever handle_collection() returned for it
+        :return: An iterable of dictionaries, possibly empty
+        """
+        item = dict(ack_item)
+        if '_item_id' in item:
+            item['_dependency_item_id'] = item.pop('_item_id')
+        return [item]
+
+    def shard_of(self, position, item):
+        """
+        Returns the index of the shard owning an item from items() when running several sharded distributors.
+        Items owned by other shards are skipped.
+
+        The default partitions the item range round-robin by position. Override to partition the key space
+        instead, for example by returning zlib.crc32(item['key']) % self.n_shards. Tasks whose items() only
+        produces their own slice, using self.shard_index and self.n_shards, should return self.shard_index.
+
+        :param int position: The position of the item in items()
+        :param dict item: The item
+        :return int: A shard index
+        """
+        return position % self.n_shards
+
+    def next_item_id(self):
+        """
+        :return int: The next _item_id, unique within the task across all shards
+        """
+        item_id = self._next_id * self.n_shards + self.shard_index
+        self._next_id += 1
+        return item_id
+
+    def pull_items(self, n):
+        """
+        Takes up to n items owned by this shard from items(), marking the source exhausted when it runs out.
+        Items are stamped with their _item_id as they are taken, so ids are stable across runs, and items the
+        task's journal records as done are skipped.
+        """
+        pulled = []
+        for item in self._source:
+            position = self._source_position
+            self._source_position += 1
+            if self.n_shards > 1 and self.shard_of(position, item) != self.shard_index:
+                continue
+
+            if isinstance(item, dict) and '_item_id' not in item:
+                item['_item_id'] = self.next_item_id()
+            if self.journal and isinstance(item, dict) and self.journal.is_done(item['_item_id']):
+                # ACKed in a previous run
+                continue
+            pulled.append(item)
+            if len(pulled) == n:
+                break
+        else:
+            logger.debug('Item source of task type %s is exhausted', self.task_type)
+            self.source_exhausted = True
+        return pulled
+
     def handle(self, data, address, msgtype, ack_data={}):
         """
-        Handle invocation by the distributor.
+        Handle invocation by the distributor. Tasks that don't stream their work from items() must implement this.
 
         :param dict data: Meta data, if provided, otherwise an empty dictionary
         :param EndpointAddress address: The address of the worker data will be sent to.
@@ -115,22 +270,119 @@ class Task(object):
         :param dict ack_data: Data received in the most recent ACK from collector
         :return dict: A dictionary of data to be sent to the worker, or None, in which case the worker will receive no information
         """
-        pass
+        raise NotImplementedError('Tasks must implement either handle() or items()')
 
 
-    def is_task_ready_for_initialization(self):
-        if self.is_complete or self.received_init_signal:
-            # if complete or already received an init signal, it cannot be initialized
-            return False
+    def handle_batch(self, data, address, msgtype, ack_data={}):
+        """
+        Handle invocation by the distributor, returning the items to be sent to a worker in a single message.
+        More than one item is sent only when batch_size is greater than one.
 
-        deps = self.dependencies
-        if not deps:
-            # if no dependency, it's ready for init + processing
-            return True
-        else:
-            # otherwise, all dependencies must be complete
-            for dep in deps:
-                if any([not i.is_complete for i in Task.task_instances[dep]]):
-                    return False
-            return True
+        Tasks with a deadline_buffer dispatch earliest deadline first, see take_by_deadline(). Otherwise items are
+        taken with take_batch().
+
+        :param dict data: Meta data, if provided, otherwise an empty dictionary
+        :param EndpointAddress address: The address of the worker data will be sent to.
+        :param str msgtype: The message type received from the worker. Typically zmqpipeline.messages.MESSAGE_TYPE_READY
+        :param dict ack_data: Data received in the most recent ACK from collector
+        :return list: A list of dictionaries, one per work item. An empty list sends nothing to the worker
+        """
+        if self.deadline_buffer:
+            return self.take_by_deadline(data, address, msgtype, ack_data)
+        return self.take_batch(data, address, msgtype, ack_data)
+
+
+    def take_batch(self, data, address, msgtype, ack_data={}):
+        """
+        Takes the next items in order. The default implementation takes resumed items, then items from the backlog first. It then takes
+        up to batch_size items from items() when it is defined, and otherwise invokes handle() up to batch_size times,
+        stopping early once the task is complete. Tasks with streaming dependencies only take items from the backlog.
+
+        :param dict data: Meta data, if provided, otherwise an empty dictionary
+        :param EndpointAddress address: The address of the worker data will be sent to.
+        :param str msgtype: The message type received from the worker. Typically zmqpipeline.messages.MESSAGE_TYPE_READY
+        :param dict ack_data: Data received in the most recent ACK from collector
+        :return list: A list of dictionaries, one per work item. An empty list sends nothing to the worker
+        """
+        items = []
+        if self._resumed is not None:
+            items.extend(itertools.islice(self._resumed, self.batch_size))
+            if len(items) < self.batch_size:
+                self._resumed = None
+
+        backlog = self.backlog
+        while backlog and len(items) < self.batch_size:
+            items.append(backlog.popleft())
+
+        if self.source_exhausted or self.stream_dependencies or len(items) == self.batch_size:
+            return items
 
+        if self._source is None:
+            source = self.items()
+            if source is not None:
+                self._source = iter(source)
+
+        if self._source is not None:
+            return items + self.pull_items(self.batch_size - len(items))
+
+        while len(items) < self.batch_size and not self.is_complete:
+            items.append(self.handle(dict(data), address, msgtype, ack_data))
+        return items
+
+
+    def take_by_deadline(self, data, address, msgtype, ack_data={}):
+        """
+        Pulls up to deadline_buffer items ahead with take_batch() and takes the items with the earliest _deadline,
+        a unix timestamp. Items without a deadline come last, in order. Items due within deadline_margin seconds
+        are expired instead of sent.
+
+        :return list: A list of dictionaries, one per work item
+        """
+        heap = self.deadline_heap
+        while True:
+            while len(heap) < self.deadline_buffer:
+                pulled = self.take_batch(data, address, msgtype, ack_data)
+                if not pulled:
+                    break
+                for item in pulled:
+                    deadline = item.get('_deadline') if isinstance(item, dict) else None
+                    heappush(heap, (deadline is None, deadline, next(self._deadline_counter), item))
+
+            cutoff = time.time() + self.deadline_margin
+            items = []
+            while heap and len(items) < self.batch_size:
+                _, deadline, _, item = heappop(heap)
+                if deadline is not None and deadline < cutoff:
+                    self.n_expired += 1
+                    item = self.handle_expired(item)
+                    if item is None:
+                        continue
+                items.append(item)
+
+            if items or not heap:
+                return items
+
+
+    def handle_expired(self, item):
+        """
+        Invoked on items that can no longer be sent in time. The default is to drop them.
+
+        :param dict item: The expired item
+        :return dict: An item to send in its place, such as a cheaper version of it, or None to drop it
+        """
+        logger.debug('Dropping item of task type %s past its deadline: %s', self.task_type, item)
+        return None
+
+
+    def update_is_complete(self):
+        """
+        Marks a streaming task complete once its item source is exhausted, its backlog is empty, no items are
+        waiting for the worker they are routed to or on their deadline, and all items sent have been ACKed.
+        The source of a task with streaming dependencies is exhausted once all of its dependencies are complete.
+
+        :return bool: True if the task is complete
+        """
+        if self.source_exhausted and self._resumed is None and not self.backlog and not self.n_routed \
+                and not self._deadline_heap and self.n_acks >= self.n_sent:
+            self.is_complete = True
+        return self.is_complete
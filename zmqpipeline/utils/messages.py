@@ -6,10 +6,24 @@ MESSAGE_TYPE_FAILURE = 'FAIL'
 MESSAGE_TYPE_READY = 'RDY'
 MESSAGE_TYPE_END = 'END'
 MESSAGE_TYPE_DATA = 'DATA'
+MESSAGE_TYPE_BATCH = 'BATCH'
 MESSAGE_TYPE_META_DATA = 'METADATA'
 MESSAGE_TYPE_EMPTY = ''
 MESSAGE_TYPE_UNKNOWN = 'UNK'
 MESSAGE_TYPE_ROUTING = 'RTE'
+MESSAGE_TYPE_CREDIT = 'CRD'
+MESSAGE_TYPE_HEARTBEAT = 'HB'
+MESSAGE_TYPE_REVOKE = 'RVK'
+
+
+# keys the distributor attaches to work items, carried by workers onto their results
+ITEM_KEYS = ('_item_id', '_shard')
+
+# the key under which workers report the seconds spent processing an item, carried by the collector onto ACK records
+ELAPSED_KEY = '_elapsed'
+
+# the key flagging ACK records of results the collector dropped as duplicates
+DUPLICATE_KEY = '_duplicate'
 
 
 ALL_MESSAGE_TYPES = [
@@ -19,8 +33,12 @@ ALL_MESSAGE_TYPES = [
     MESSAGE_TYPE_READY,
     MESSAGE_TYPE_END,
     MESSAGE_TYPE_DATA,
+    MESSAGE_TYPE_BATCH,
     MESSAGE_TYPE_META_DATA,
-    MESSAGE_TYPE_EMPTY
+    MESSAGE_TYPE_EMPTY,
+    MESSAGE_TYPE_CREDIT,
+    MESSAGE_TYPE_HEARTBEAT,
+    MESSAGE_TYPE_REVOKE
 ]
 
 
@@ -42,6 +60,9 @@ def create(data, tasktype, msgtype):
 def create_data(task, data):
     return create(data, task, MESSAGE_TYPE_DATA)
 
+def create_batch(task, items):
+    return create(items, task, MESSAGE_TYPE_BATCH)
+
 def create_metadata(metadata):
     return create(metadata, '', MESSAGE_TYPE_META_DATA)
 
@@ -79,6 +100,49 @@ def create_end(task = '', data=''):
 def create_routing(task = '', data = ''):
     return _create_type(MESSAGE_TYPE_ROUTING, task, data)
 
+def create_credit(task = '', data = 1):
+    return _create_type(MESSAGE_TYPE_CREDIT, task, data)
+
+def create_heartbeat(task = '', data = ''):
+    return _create_type(MESSAGE_TYPE_HEARTBEAT, task, data)
+
+def create_revoke(task = '', data = None):
+    return _create_type(MESSAGE_TYPE_REVOKE, task, data)
+
+
+def carry_item_keys(src, dst):
+    """
+    Copies the keys attached by the distributor from a work item onto its result
+    :param dict src: The work item received from the distributor
+    :param dict dst: The result sent to the collector
+    :return: dst
+    """
+    for key in ITEM_KEYS:
+        if key in src:
+            dst[key] = src[key]
+    return dst
+
+
+def add_elapsed(results, elapsed):
+    """
+    Adds the time spent processing a message to its results, split evenly between them
+    :param list results: The results of the message
+    :param float elapsed: The number of seconds spent processing the message
+    """
+    if not results:
+        return
+    share = float(elapsed) / len(results)
+    for result in results:
+        result[ELAPSED_KEY] = result.get(ELAPSED_KEY, 0.0) + share
+
+
+def item_ids(data, msgtype):
+    """
+    :return list: The ids the distributor attached to the items of a DATA or BATCH message
+    """
+    items = (data or []) if msgtype == MESSAGE_TYPE_BATCH else [data or {}]
+    return [item['_item_id'] for item in items if item and '_item_id' in item]
+
 
 def get(msg):
     """
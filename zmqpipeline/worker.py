@@ -1,18 +1,35 @@
 from abc import ABCMeta, abstractmethod, abstractproperty
 import logging
+import os
+import shutil
+import tempfile
+import time
 
 from utils import messages
 from descriptors import TaskType, EndpointAddress
+from result_buffer import ResultBuffer
+from cache import ResultCache, cache_key, CACHE_KEY
 
 import zmq
 import zhelpers
 import helpers
-from threading import Thread
+from collections import defaultdict, deque
+from threading import Thread, Event
+from multiprocessing import Process
+
+try:
+    import gevent
+    import gevent.event
+    import gevent.pool
+    import zmq.green as zmq_green
+except ImportError:
+    gevent = None
 
 
 class WorkerMeta(ABCMeta):
     def __new__(cls, name, bases, dct):
-        if name not in ('Worker', 'MultiThreadedWorker', 'SingleThreadedWorker', 'ServiceWorker'):
+        if name not in ('Worker', 'PoolWorker', 'MultiThreadedWorker', 'MultiProcessWorker', 'SingleThreadedWorker',
+                        'GreenWorker', 'ServiceWorker'):
             if 'task_type' in dct and not isinstance(dct['task_type'], TaskType):
                 raise TypeError('task_type is required to be a TaskType enumerated value')
 
@@ -37,13 +54,41 @@ class WorkerMeta(ABCMeta):
 class Worker(object):
     """
     An abstract entity capable of doing work. This cannot be instantiated by client code.
-    Instead, subclass and instantiate SingleThreadedWorker and MultiThreadedWorker
+    Instead, subclass and instantiate SingleThreadedWorker, MultiThreadedWorker or MultiProcessWorker
 
-    Both SingleThreadedWorker and MultiThreadedWorker inherit from Worker.
+    SingleThreadedWorker, MultiThreadedWorker and MultiProcessWorker all inherit from Worker.
     Note that MetaDataWorker does not inherit from Worker despite its name.
     """
     __metaclass__ = WorkerMeta
 
+    # number of tasks the distributor may keep outstanding on this worker. A value of one
+    # keeps the classic lockstep REQ/REP exchange; larger values switch to credit mode.
+    # Can also be passed to the constructor as the credit_window keyword argument
+    credit_window = 1
+
+    # the shard of the distributor this worker connects to when running sharded distributors.
+    # Can also be passed to the constructor as the shard_index keyword argument
+    shard_index = None
+
+    # when set to the distributor's heartbeat endpoint, a background thread sends a heartbeat every
+    # heartbeat_interval seconds so the distributor can redeliver the work of workers that die
+    heartbeat_endpoint = None
+    heartbeat_interval = 1.0
+
+    # the zmq context class sockets are created from
+    context_class = zmq.Context
+
+    # when set, results are coalesced into messages of up to result_batch_size results, sent at the latest
+    # result_flush_interval seconds after being produced, so the collector unpacks and ACKs fewer messages
+    result_batch_size = None
+    result_flush_interval = 0.01
+
+    # when set, results are cached by a hash of the item they were produced from. The cache_size most recently used
+    # results are kept in memory, and when cache_dir is set too every result is stored there, shared by the workers
+    # of a host. Items found in the cache skip handle_execution() and are sent straight to the collector
+    cache_size = None
+    cache_dir = None
+
     @abstractproperty
     def task_type(self):
         return None
@@ -59,29 +104,191 @@ class Worker(object):
     def __init__(self, *args, **kwargs):
         self.logger = logging.getLogger('zmqpipeline.worker')
 
-        self.context = zmq.Context()
+        self.context = self.context_class()
 
         self.logger.info('Worker connecting to collector endpoint: %s', self.collector_endpoint)
         self.sender = self.context.socket(zmq.PUSH)
         self.sender.connect(self.collector_endpoint)
-
-        self.logger.info('Worker connecting to endpoint: %s', self.endpoint)
-        self.worker = self.context.socket(zmq.REQ)
+        self.results = self.create_result_buffer(self.sender)
+        self.cache = ResultCache(self.cache_size, self.cache_dir) if self.cache_size else None
+
+        self.credit_window = kwargs.get('credit_window', self.credit_window)
+        if self.credit_window < 1:
+            raise ValueError('credit_window must be a positive integer')
+
+        # credits of finished tasks are handed back in batches of half the window, so the distributor
+        # receives fewer messages while the window stays at least half full
+        self.credit_batch = max(1, self.credit_window // 2)
+        self.unreturned_credits = 0
+
+        self.shard_index = kwargs.get('shard_index', self.shard_index)
+        endpoint = self.endpoint
+        if self.shard_index is not None:
+            endpoint = helpers.shard_endpoint(endpoint, self.shard_index)
+
+        self.logger.info('Worker connecting to endpoint: %s', endpoint)
+        if self.credit_mode:
+            self.logger.info('Using credit window of %d tasks', self.credit_window)
+            self.worker = self.context.socket(zmq.DEALER)
+        else:
+            self.worker = self.context.socket(zmq.REQ)
         zhelpers.set_id(self.worker)
-        self.worker.connect(self.endpoint)
+        self.worker.connect(endpoint)
 
         self.worker_id = self.worker.getsockopt(zmq.IDENTITY)
         self.logger.info('Setting worker id: %s', self.worker_id)
 
         self.metadata = {}
+        self.heartbeat_stop = Event()
+
+
+    @property
+    def credit_mode(self):
+        return self.credit_window > 1
+
+
+    def send_to_distributor(self, msg):
+        if self.credit_mode:
+            # DEALER sockets don't add the empty delimiter frame REQ sockets do
+            self.worker.send_multipart([b'', msg])
+        else:
+            self.worker.send(msg)
+
+
+    def recv_from_distributor(self):
+        if self.credit_mode:
+            empty, msg = self.worker.recv_multipart()
+            return msg
+        return self.worker.recv()
+
+
+    def create_result_buffer(self, socket):
+        """
+        :param socket: A socket connected to the collector
+        :return ResultBuffer: A buffer sending results on the socket as configured on the worker
+        """
+        return ResultBuffer(socket, self.task_type, self.result_batch_size, self.result_flush_interval)
+
+
+    def wait_for_message(self, socket, results):
+        """
+        Waits for a message to arrive on socket, sending buffered results as they fall due in the meantime.
+        """
+        while not socket.poll(results.timeout()):
+            results.flush()
+
+
+    def request_work(self, n=1):
+        """
+        Asks the distributor for more work. In lockstep mode this sends a single READY message.
+        In credit mode this hands n credits back to the distributor, which will keep up to that
+        many more tasks outstanding on this worker.
+
+        :param int n: The number of credits to hand back. Ignored in lockstep mode
+        """
+        if self.credit_mode:
+            self.send_to_distributor(messages.create_credit(self.task_type, n))
+        else:
+            self.send_to_distributor(messages.create_ready(self.task_type))
+
+
+    def revoke(self, queue, item_ids):
+        """
+        Takes the messages revoked by the distributor out of a queue of messages that haven't been started, and tells
+        the distributor which items it can send to other workers. A message is only taken out when all of its items
+        are revoked, so items of a message are never split between workers.
+
+        :param deque queue: Pairs of item ids and messages, in the order they are to be started
+        :param list item_ids: The ids of the items revoked by the distributor
+        """
+        item_ids = set(item_ids or [])
+        kept = []
+        revoked = []
+        n_messages = 0
+        for ids, msg in queue:
+            if ids and item_ids.issuperset(ids):
+                revoked.extend(ids)
+                n_messages += 1
+            else:
+                kept.append((ids, msg))
+
+        queue.clear()
+        queue.extend(kept)
+        self.logger.debug('Handing %d revoked items back to the distributor', len(revoked))
+        self.send_to_distributor(messages.create_revoke(self.task_type, {'items': revoked, 'n_messages': n_messages}))
+
+
+    def work_done(self):
+        """
+        Accounts for a finished task, asking the distributor for more work once enough credits have been freed up.
+        """
+        if not self.credit_mode:
+            self.request_work()
+            return
+
+        self.unreturned_credits += 1
+        if self.unreturned_credits >= self.credit_batch:
+            self.request_work(self.unreturned_credits)
+            self.unreturned_credits = 0
+
+
+    def start_heartbeat(self):
+        if self.heartbeat_endpoint is None:
+            return
+
+        endpoint = self.heartbeat_endpoint
+        if self.shard_index is not None:
+            endpoint = helpers.shard_endpoint(endpoint, self.shard_index)
+
+        self.heartbeat_stop.clear()
+        self.spawn(self.heartbeat_loop, endpoint)
+
+
+    def spawn(self, target, *args):
+        """
+        Runs target in the background
+        """
+        t = Thread(target = target, args = args)
+        t.daemon = True
+        t.start()
+
+
+    def stop_heartbeat(self):
+        self.heartbeat_stop.set()
+
+
+    def heartbeat_loop(self, endpoint):
+        """
+        Sends heartbeats on a socket of its own, so they keep flowing while the worker is busy executing
+        """
+        self.logger.info('Sending heartbeats to endpoint %s every %.1f seconds', endpoint, self.heartbeat_interval)
+        s = self.context.socket(zmq.PUSH)
+        s.setsockopt(zmq.LINGER, 0)
+        s.connect(endpoint)
+
+        while not self.heartbeat_stop.is_set():
+            try:
+                s.send(messages.create_heartbeat(self.task_type, self.worker_id), zmq.NOBLOCK)
+            except zmq.Again:
+                self.logger.debug('Distributor is not receiving heartbeats')
+            self.heartbeat_stop.wait(self.heartbeat_interval)
+        s.close()
 
 
     def send_init_msg(self):
+        """
+        Announces the worker to the distributor and waits for its init reply.
+
+        :return bool: False if the distributor shut down before initializing the worker
+        """
         self.logger.info('Sending init message to %s' % self.endpoint)
 
-        self.worker.send(b'')
-        msg = self.worker.recv()
+        self.send_to_distributor(b'')
+        msg = self.recv_from_distributor()
         data, _, msgtype = messages.get(msg)
+        if msgtype == messages.MESSAGE_TYPE_END:
+            self.logger.info('Worker received END message before initialization')
+            return False
         assert msgtype == messages.MESSAGE_TYPE_META_DATA
 
         self.metadata = data
@@ -95,6 +302,7 @@ class Worker(object):
             initfn()
         else:
             self.logger.info('No initialization method found (init_worker() not defined). Skipping initiliaization.')
+        return True
 
 
     @abstractmethod
@@ -115,8 +323,243 @@ class Worker(object):
         """
         pass
 
+    @property
+    def execution_cache(self):
+        """
+        The cache looked up before invoking handle_execution(), or None
+        """
+        return self.cache
+
+
+    def execute(self, data):
+        """
+        Invokes handle_execution() on a single item, carrying the keys attached by the distributor onto the result
+        along with the time it took. Items found in the cache skip handle_execution()
+        """
+        start = time.time()
+        cache = self.execution_cache
+        key = sdata = None
+        if cache is not None:
+            key = cache_key(data)
+            sdata = cache.get(key)
+
+        if sdata is None:
+            sdata = self.handle_execution(data) or {}
+            if key:
+                cache.put(key, sdata)
+        sdata = messages.carry_item_keys(data, sdata)
+        messages.add_elapsed([sdata], time.time() - start)
+        return sdata
+
+
+    def execute_batch(self, items):
+        """
+        Invokes handle_execution_batch() on a batch of items, carrying the keys attached by the distributor onto the results
+        along with the time they took. Items found in the cache are left out of the batch
+        """
+        start = time.time()
+        cache = self.execution_cache
+        keys = [None] * len(items)
+        results = [None] * len(items)
+        if cache is not None:
+            keys = [cache_key(data) for data in items]
+            results = [cache.get(key) for key in keys]
+
+        misses = [i for i, sdata in enumerate(results) if sdata is None]
+        if misses:
+            computed = self.handle_execution_batch([items[i] for i in misses])
+            for i, sdata in zip(misses, computed):
+                results[i] = sdata or {}
+                if keys[i]:
+                    cache.put(keys[i], results[i])
+
+        for i, sdata in enumerate(results):
+            results[i] = messages.carry_item_keys(items[i] or {}, sdata)
+        messages.add_elapsed(results, time.time() - start)
+        return results
+
+
+    def handle_execution_batch(self, items, *args, **kwargs):
+        """
+        Invoked in place of handle_execution() when the distributor sends a batch of items,
+        i.e. when the corresponding task has a batch_size greater than one.
+
+        The default implementation invokes handle_execution() on each item in turn.
+
+        :param list items: A list of dictionaries provided by the distributor
+        :param args: A list of additional positional arguments
+        :param kwargs: A list of additional keyword arguments
+        :return list: A list of dictionaries, one per item
+        """
+        return [self.handle_execution(data or {}, *args, **kwargs) or {} for data in items]
+
+
+class PoolWorker(Worker):
+    """
+    A worker that hands data off to a pool of threads or processes. This cannot be instantiated by client code.
+    Instead, subclass and instantiate MultiThreadedWorker or MultiProcessWorker
+    """
+    def init_pool_member(self, worker_index):
+        initfn = getattr(self, 'init_thread', None)
+        if initfn and callable(initfn):
+            self.logger.info('Thread initialization method found. Invoking init_thread()')
+            initfn(worker_index = worker_index)
+        else:
+            self.logger.info('No thread initialization found (init_thread() undefined). Skipping thread initialization.')
+
+
+    @property
+    def execution_cache(self):
+        # handle_execution() only forwards items to the pool, so results are cached around the pool instead
+        return None
+
+
+    def execute_in_pool(self, data, msgtype, worker_index):
+        """
+        Invokes handle_thread_execution() or handle_thread_execution_batch() on a message handed off by the worker,
+        adding the time it took to the time the worker spent on the results
+
+        :return tuple: The message type and data to send to the collector
+        """
+        start = time.time()
+        if msgtype == messages.MESSAGE_TYPE_BATCH:
+            keys = [(item or {}).pop(CACHE_KEY, None) for item in data]
+            self.logger.debug('Worker thread %d invoking handle_thread_execution_batch with %d items', worker_index, len(data))
+            results = self.handle_thread_execution_batch(items = data, index = worker_index)
+            self.cache_results(keys, results)
+            messages.add_elapsed(results, time.time() - start)
+            return msgtype, results
+
+        data = data or {}
+        key = data.pop(CACHE_KEY, None)
+        self.logger.debug('Worker thread %d invoking handle_thread_execution with data: %s', worker_index, data)
+        sdata = self.handle_thread_execution(data = data, index = worker_index)
+        if sdata:
+            data.update(sdata)
+        self.cache_results([key], [data])
+        messages.add_elapsed([data], time.time() - start)
+        return messages.MESSAGE_TYPE_DATA, data
+
+
+    def cache_results(self, keys, results):
+        if self.cache is None:
+            return
+        for key, result in zip(keys, results):
+            if key:
+                self.cache.put(key, result)
+
+
+    def send_cached(self, items):
+        """
+        Sends the cached results of items to the collector.
+
+        :return tuple: The items not found in the cache, and their cache keys
+        """
+        hits, misses, keys = [], [], []
+        for data in items:
+            data = data or {}
+            key = cache_key(data)
+            result = self.cache.get(key)
+            if result is None:
+                misses.append(data)
+                keys.append(key)
+            else:
+                hits.append(messages.carry_item_keys(data, result))
+
+        if hits:
+            self.logger.debug('Sending %d cached results to collector', len(hits))
+            self.results.add(messages.MESSAGE_TYPE_BATCH, hits)
+        return misses, keys
+
+
+    def hand_off(self, msg):
+        """
+        Invokes handle_execution() on a message received from the distributor. Items found in the cache are sent
+        straight to the collector instead.
+
+        :return tuple: The ids of the items handed off and the message to hand them off with,
+            or None if all items were found in the cache
+        """
+        data, tt, msgtype = messages.get(msg)
+        batch = msgtype == messages.MESSAGE_TYPE_BATCH
+        items = (data or []) if batch else [data or {}]
+
+        keys = None
+        if self.cache is not None:
+            items, keys = self.send_cached(items)
+            if not items:
+                return None
+
+        if batch:
+            self.logger.debug('Invoking handle_execution_batch with %d items', len(items))
+            results = self.execute_batch(items)
+        else:
+            self.logger.debug('Invoking handle_execution with data: %s', items[0])
+            results = [self.execute(items[0])]
+
+        # the thread caches the result it produces under the key of the item received from the distributor
+        if keys:
+            for result, key in zip(results, keys):
+                result[CACHE_KEY] = key
+
+        ids = messages.item_ids(results, messages.MESSAGE_TYPE_BATCH)
+        if batch:
+            return ids, messages.create_batch(self.task_type, results)
+        return ids, messages.create_data(self.task_type, results[0])
+
+
+    @abstractmethod
+    def handle_execution(self, data, *args, **kwargs):
+        """
+        This method is invoked when the worker's main loop is executed. Client implementions
+        of this method should, unlike the SingleThreadedWorker, not process data but instead
+        forward the relevant data to the thread by returning a dictionary of information.
+
+        :param dict data: A dictionary of data received by the worker
+        :param args: Additional arguments
+        :param kwargs: Additional keyword arguments
+
+        :return dict: Data to be forwarded to the worker thread
+        """
+        return {}
+
 
-class MultiThreadedWorker(Worker):
+    @abstractmethod
+    def handle_thread_execution(self, data, index):
+        """
+        This method is invoked in the working thread. This is where data processing should be
+        handled.
+
+        :param dict data: A dictionary of data provided by the worker
+        :param int index: The index number of the thread that's been invoked
+        :return dict: A dictionary of information to be forwarded to the collector
+        """
+        return {}
+
+
+    def handle_thread_execution_batch(self, items, index):
+        """
+        Invoked in the working thread when the worker forwards a batch of items. Results are
+        sent to the collector as a single message.
+
+        The default implementation invokes handle_thread_execution() on each item in turn.
+
+        :param list items: A list of dictionaries provided by the worker
+        :param int index: The index number of the thread that's been invoked
+        :return list: A list of dictionaries to be forwarded to the collector, one per item
+        """
+        results = []
+        for data in items:
+            data = data or {}
+            sdata = self.handle_thread_execution(data = data, index = index)
+            if sdata:
+                data.update(sdata)
+            results.append(data)
+        return results
+
+
+
+class MultiThreadedWorker(PoolWorker):
     """
     A worker that processes data on multiple threads.
 
@@ -125,9 +568,15 @@ class MultiThreadedWorker(Worker):
     Morever, data is forwarded from the worker to each thread over the inproc protocol by default,
     which is significantly faster than tcp or ipc.
 
+    Items received from the distributor are staged in a local queue and handed to whichever thread is idle,
+    so threads never wait on a round trip to the distributor. The queue is bounded by the credit window,
+    which defaults to twice the number of threads.
     """
     thread_endpoint = EndpointAddress('inproc://threadworker')
 
+    # defaults to twice n_threads
+    credit_window = None
+
     @abstractproperty
     def n_threads(self):
         """
@@ -138,8 +587,11 @@ class MultiThreadedWorker(Worker):
         return 1
 
     def __init__(self, *args, **kwargs):
+        if self.credit_window is None:
+            self.credit_window = 2 * self.n_threads
+
         super(MultiThreadedWorker, self).__init__(*args, **kwargs)
-        self.thread_router = self.context.socket(zmq.REP)
+        self.thread_router = self.context.socket(zmq.ROUTER)
         self.thread_router.bind(helpers.endpoint_binding(self.thread_endpoint))
 
 
@@ -149,17 +601,17 @@ class MultiThreadedWorker(Worker):
         zhelpers.set_id(w)
         w.connect(self.thread_endpoint)
 
-        initfn = getattr(self, 'init_thread', None)
-        if initfn and callable(initfn):
-            self.logger.info('Thread initialization method found. Invoking init_thread()')
-            initfn(worker_index = worker_index)
-        else:
-            self.logger.info('No thread initialization found (init_thread() undefined). Skipping thread initialization.')
+        # zmq sockets can't be shared between threads, so each thread sends its results on a socket of its own
+        sender = context.socket(zmq.PUSH)
+        sender.connect(self.collector_endpoint)
+        results = self.create_result_buffer(sender)
 
+        self.init_pool_member(worker_index)
 
         while True:
             w.send(messages.create_ready())
 
+            self.wait_for_message(w, results)
             msg = w.recv()
             data, tt, msgtype = messages.get(msg)
 
@@ -168,15 +620,13 @@ class MultiThreadedWorker(Worker):
             if msgtype == messages.MESSAGE_TYPE_END:
                 break
 
-            data = data or {}
-            self.logger.debug('Worker thread %d invoking handle_thread_execution with data: %s', worker_index, data)
-            sdata = self.handle_thread_execution(data = data, index = worker_index)
-            if sdata:
-                data.update(sdata)
+            self.logger.debug('Sending data to collector')
+            results.add(*self.execute_in_pool(data, msgtype, worker_index))
+            results.flush_if_due()
 
-            self.logger.debug('Sending data to collector: %s', data)
-            smsg = messages.create_data(self.task_type, data)
-            self.sender.send(smsg)
+        results.flush()
+        w.close()
+        sender.close()
 
 
 
@@ -185,70 +635,339 @@ class MultiThreadedWorker(Worker):
         for i in range(self.n_threads):
             Thread(target = self.worker_thread, args=[i, self.context]).start()
 
-    def shutdown_threads(self):
+    def shutdown_threads(self, idle_threads = ()):
+        """
+        Sends END to every thread
+
+        :param idle_threads: The addresses of the threads already waiting on work
+        """
         self.logger.info('Shutting down %d threads', self.n_threads)
-        for _ in range(self.n_threads):
-            self.thread_router.recv()
-            self.thread_router.send(messages.create_end(task = self.task_type))
+        for address in idle_threads:
+            self.thread_router.send_multipart([address, b'', messages.create_end(task = self.task_type)])
+        for _ in range(self.n_threads - len(idle_threads)):
+            address, empty, ready = self.thread_router.recv_multipart()
+            self.thread_router.send_multipart([address, b'', messages.create_end(task = self.task_type)])
 
 
     def main_loop(self):
         self.logger.info('Multi threaded worker running at address %s, ID: %s', self.endpoint, self.worker_id)
 
-        while True:
-            self.worker.send(messages.create_ready(self.task_type))
+        poller = zmq.Poller()
+        poller.register(self.worker, zmq.POLLIN)
+        poller.register(self.thread_router, zmq.POLLIN)
+
+        # threads waiting on work, and items waiting on a thread
+        idle_threads = deque()
+        staged = deque()
+        ending = False
+
+        self.request_work(self.credit_window)
+        while not ending or staged:
+            # cached results are sent from this thread
+            socks = dict(poller.poll(self.results.timeout()))
+            self.results.flush_if_due()
+
+            if socks.get(self.thread_router) == zmq.POLLIN:
+                address, empty, ready = self.thread_router.recv_multipart()
+                idle_threads.append(address)
+
+            if socks.get(self.worker) == zmq.POLLIN:
+                msg = self.recv_from_distributor()
+                data, tt, msgtype = messages.get(msg)
+                assert tt == self.task_type
+
+                if msgtype == messages.MESSAGE_TYPE_END:
+                    self.logger.info('Worker received END message with %d items staged', len(staged))
+                    poller.unregister(self.worker)
+                    ending = True
+                elif msgtype == messages.MESSAGE_TYPE_REVOKE:
+                    self.revoke(staged, data)
+                else:
+                    handed_off = self.hand_off(msg)
+                    if handed_off is None:
+                        # every item was found in the cache
+                        self.work_done()
+                    else:
+                        staged.append(handed_off)
+
+            while idle_threads and staged:
+                ids, smsg = staged.popleft()
+                self.thread_router.send_multipart([idle_threads.popleft(), b'', smsg])
+
+                # the task has been handed off to a thread, freeing its slot in the credit window
+                if not ending:
+                    self.work_done()
+
+        self.results.flush()
+        self.logger.info('Shutting down threads.')
+        self.shutdown_threads(idle_threads)
+        self.logger.info('Threads are shutdown')
+
 
-            msg = self.worker.recv()
+    def run(self):
+        self.start_heartbeat()
+        self.init_threads()
+        if self.send_init_msg():
+            self.main_loop()
+        else:
+            self.shutdown_threads()
+        self.stop_heartbeat()
+
+
+
+class MultiProcessWorker(PoolWorker):
+    """
+    A worker that processes data on a pool of child processes, so CPU bound handlers run in parallel
+    instead of contending for the GIL.
+
+    handle_execution() runs in the worker process and handle_thread_execution() in the child processes, exactly
+    as with the MultiThreadedWorker, and init_thread() is invoked once in each child process. Data is forwarded
+    to the children over an ipc socket in a private temporary directory, and each child sends its results
+    to the collector itself.
+
+    Children are forked, so they inherit the state of the worker at the time they start. Data passed to them
+    must be serializable by msgpack.
+
+    The worker keeps the messages each child is working on, and those whose results it hasn't sent yet. When a child
+    crashes, they are handed to another child.
+    """
+    # a child process exits after handling this many messages and is replaced by a fresh one, which caps the
+    # memory a leaky handler can grow to. None keeps children running until the worker shuts down
+    max_tasks_per_process = None
+
+    # a message is failed once it was held by this many children that crashed, rather than crash yet another one
+    max_process_crashes = 3
+
+    # the number of seconds a child gets to flush its last results to the collector when exiting
+    process_linger = 5.0
+
+    @abstractproperty
+    def n_processes(self):
+        """
+        The number of child processes used.
+
+        :return int: A positive integer
+        """
+        return 1
+
+    def __init__(self, *args, **kwargs):
+        super(MultiProcessWorker, self).__init__(*args, **kwargs)
+        if self.max_tasks_per_process is not None and self.max_tasks_per_process < 1:
+            raise ValueError('max_tasks_per_process must be a positive integer')
+
+        self.process_dir = tempfile.mkdtemp(prefix = 'zmqpipeline-')
+        self.process_endpoint = 'ipc://' + os.path.join(self.process_dir, 'processes.ipc')
+        self.process_router = self.context.socket(zmq.ROUTER)
+        self.process_router.bind(self.process_endpoint)
+        self.processes = {}
+
+        # pairs of messages and the number of children that crashed holding them, keyed on the ids of the children
+        # holding them, and waiting for another child
+        self.held = defaultdict(list)
+        self.lost = deque()
+        # the ids of children sent END
+        self.ended = set()
+
+
+    def worker_process(self, worker_index):
+        # the context of the parent is unusable after a fork, so the child talks over sockets of its own
+        context = zmq.Context()
+        w = context.socket(zmq.REQ)
+        # the worker tells which child exited from its pid
+        w.setsockopt(zmq.IDENTITY, str(os.getpid()))
+        w.connect(self.process_endpoint)
+        sender = context.socket(zmq.PUSH)
+        sender.connect(self.collector_endpoint)
+        results = self.create_result_buffer(sender)
+
+        self.init_pool_member(worker_index)
+
+        n_tasks = 0
+        while self.max_tasks_per_process is None or n_tasks < self.max_tasks_per_process:
+            # the worker keeps the messages handled since results were last sent, as they'd be lost in a crash
+            w.send(messages.create_ready(self.task_type, len(results)))
+
+            self.wait_for_message(w, results)
+            msg = w.recv()
             data, tt, msgtype = messages.get(msg)
+
             assert tt == self.task_type
 
             if msgtype == messages.MESSAGE_TYPE_END:
-                self.logger.info('Worker received END message. Shutting down threads.')
-                self.shutdown_threads()
-                self.logger.info('Threads are shutdown')
                 break
 
-            self.thread_router.recv()
-            data = data or {}
+            results.add(*self.execute_in_pool(data, msgtype, worker_index))
+            results.flush_if_due()
+            n_tasks += 1
 
-            self.logger.debug('Invoking handle_execution with data: %s', data)
-            sdata = self.handle_execution(data) or {}
-            self.thread_router.send(messages.create_data(self.task_type, sdata))
+        results.flush()
+        w.close(linger = 0)
+        sender.close(linger = int(self.process_linger * 1000))
+        context.term()
 
 
-    def run(self):
-        self.init_threads()
-        self.send_init_msg()
-        self.main_loop()
+    def start_process(self, worker_index):
+        p = Process(target = self.worker_process, args = [worker_index])
+        p.daemon = True
+        p.start()
+        self.processes[worker_index] = p
 
 
-    @abstractmethod
-    def handle_execution(self, data, *args, **kwargs):
+    def init_processes(self):
+        self.logger.info('Starting %d processes', self.n_processes)
+        for i in range(self.n_processes):
+            self.start_process(i)
+
+
+    def reap_processes(self, restart = True):
         """
-        This method is invoked when the worker's main loop is executed. Client implementions
-        of this method should, unlike the SingleThreadedWorker, not process data but instead
-        forward the relevant data to the thread by returning a dictionary of information.
+        Joins the children that have exited, after being recycled or crashing, and starts their replacements.
+        The messages held by crashed children are queued for other children.
 
-        :param dict data: A dictionary of data received by the worker
-        :param args: Additional arguments
-        :param kwargs: Additional keyword arguments
+        :return int: The number of children still running
+        """
+        for i, p in self.processes.items():
+            if p.is_alive():
+                continue
 
-        :return dict: Data to be forwarded to the worker thread
+            p.join()
+            identity = str(p.pid)
+            held = self.held.pop(identity, [])
+            if p.exitcode:
+                self.logger.warning('Process %d exited with code %d, holding %d messages', i, p.exitcode, len(held))
+                for msg, n_crashes in held:
+                    self.requeue(msg, n_crashes + 1)
+
+            if restart and identity not in self.ended:
+                self.logger.debug('Restarting process %d', i)
+                self.start_process(i)
+            else:
+                self.ended.discard(identity)
+                del self.processes[i]
+        return len(self.processes)
+
+
+    def requeue(self, msg, n_crashes):
         """
-        return {}
+        Queues a message held by a crashed child for another child. A message that crashed too many children is
+        dropped, and the collector is sent a FAILURE for each of its items so their task can still complete.
+        """
+        if n_crashes < self.max_process_crashes:
+            self.lost.append((msg, n_crashes))
+            return
 
+        data, tt, msgtype = messages.get(msg)
+        items = (data or []) if msgtype == messages.MESSAGE_TYPE_BATCH else [data or {}]
+        self.logger.error('Dropping %d items held by %d crashed processes', len(items), n_crashes)
+        for item in items:
+            self.sender.send(messages.create_failure(self.task_type, messages.carry_item_keys(item, {})))
 
-    @abstractmethod
-    def handle_thread_execution(self, data, index):
+
+    def wait_for_process(self, restart = True):
         """
-        This method is invoked in the working thread. This is where data processing should be
-        handled.
+        Waits for a child process to ask for work, replacing the children that exit in the meantime
 
-        :param dict data: A dictionary of data provided by the worker
-        :param int index: The index number of the thread that's been invoked
-        :return dict: A dictionary of information to be forwarded to the collector
+        :return str: The id of the child, or None if no children are left to ask for work
         """
-        return {}
+        while self.reap_processes(restart):
+            if not self.process_router.poll(100):
+                continue
+
+            identity, empty, msg = self.process_router.recv_multipart()
+            if not any(str(p.pid) == identity for p in self.processes.values()):
+                # asked before exiting
+                continue
+            if not messages.get(msg)[0]:
+                # the child has sent the results of every message it was sent
+                self.held.pop(identity, None)
+            return identity
+        return None
+
+
+    def send_to_process(self, identity, msg, n_crashes = 0):
+        self.held[identity].append((msg, n_crashes))
+        self.process_router.send_multipart([identity, b'', msg])
+
+
+    def hand_off_lost(self):
+        """
+        Hands the messages held by crashed children to other children.
+        """
+        while self.lost:
+            identity = self.wait_for_process()
+            msg, n_crashes = self.lost.popleft()
+            self.logger.info('Handing a message held by a crashed process to process %s', identity)
+            self.send_to_process(identity, msg, n_crashes)
+
+
+    def wait_for_distributor(self):
+        """
+        Waits for a message from the distributor, handing the messages of children crashing in the meantime to
+        other children and sending buffered results as they fall due.
+        """
+        while True:
+            self.hand_off_lost()
+            timeout = self.results.timeout()
+            if self.worker.poll(100 if timeout is None else min(timeout, 100)):
+                return
+            self.results.flush_if_due()
+            self.reap_processes()
+
+
+    def shutdown_processes(self):
+        self.logger.info('Shutting down %d processes', len(self.processes))
+        while True:
+            # children that crash holding messages are still replaced, so the messages are handed to other children
+            identity = self.wait_for_process(restart = bool(self.held or self.lost))
+            if identity is None:
+                break
+            if self.lost:
+                self.send_to_process(identity, *self.lost.popleft())
+            else:
+                self.ended.add(identity)
+                self.process_router.send_multipart([identity, b'', messages.create_end(task = self.task_type)])
+        shutil.rmtree(self.process_dir, ignore_errors = True)
+
+
+    def main_loop(self):
+        self.logger.info('Multi process worker running at address %s, ID: %s', self.endpoint, self.worker_id)
+
+        self.request_work(self.credit_window)
+        while True:
+            # cached results are sent from this process
+            self.wait_for_distributor()
+            msg = self.recv_from_distributor()
+            data, tt, msgtype = messages.get(msg)
+            assert tt == self.task_type
+
+            if msgtype == messages.MESSAGE_TYPE_END:
+                self.results.flush()
+                self.logger.info('Worker received END message. Shutting down processes.')
+                self.shutdown_processes()
+                self.logger.info('Processes are shutdown')
+                break
+
+            if msgtype == messages.MESSAGE_TYPE_REVOKE:
+                # items are handed off as soon as they arrive, so none are left to revoke
+                self.revoke(deque(), data)
+                continue
+
+            handed_off = self.hand_off(msg)
+            if handed_off is not None:
+                self.send_to_process(self.wait_for_process(), handed_off[1])
+
+            # the task has been handed off to a process, freeing its slot in the credit window
+            self.work_done()
+
+
+    def run(self):
+        self.start_heartbeat()
+        self.init_processes()
+        if self.send_init_msg():
+            self.main_loop()
+        else:
+            self.shutdown_processes()
+        self.stop_heartbeat()
 
 
 
@@ -259,28 +978,62 @@ class SingleThreadedWorker(Worker):
     def main_loop(self):
         self.logger.info('Single threaded worker running at address %s, ID: %s', self.endpoint, self.worker_id)
 
+        # messages received but not yet started, which the distributor may revoke
+        queue = deque()
+
+        self.request_work(self.credit_window)
         while True:
-            self.worker.send(messages.create_ready(self.task_type))
-            msg = self.worker.recv()
-            data, tt, msgtype = messages.get(msg)
-            assert tt == self.task_type
+            if not queue:
+                self.wait_for_message(self.worker, self.results)
+            self.receive_messages(queue)
+            if not queue:
+                continue
 
+            ids, (data, msgtype) = queue.popleft()
             if msgtype == messages.MESSAGE_TYPE_END:
                 self.logger.info('Worker received END message')
+                self.results.flush()
                 break
 
-            data = data or {}
-            self.logger.debug('Worker invoking handle_execution on task type %s with data: %s', self.task_type, data)
-            sdata = self.handle_execution(data) or {}
+            if msgtype == messages.MESSAGE_TYPE_BATCH:
+                self.logger.debug('Worker invoking handle_execution_batch on task type %s with %d items', self.task_type, len(data))
+                results = self.execute_batch(data)
 
-            self.logger.debug('Worker sending results from task type: %s - data: %s', self.task_type, sdata)
-            smsg = messages.create_data(self.task_type, sdata)
-            self.sender.send(smsg)
+                self.logger.debug('Worker sending %d results from task type: %s', len(results), self.task_type)
+                self.results.add(msgtype, results)
+            else:
+                data = data or {}
+                self.logger.debug('Worker invoking handle_execution on task type %s with data: %s', self.task_type, data)
+                sdata = self.execute(data)
+
+                self.logger.debug('Worker sending results from task type: %s - data: %s', self.task_type, sdata)
+                self.results.add(msgtype, sdata)
+            # a busy worker may never wait long enough for buffered results to be sent while waiting
+            self.results.flush_if_due()
+            self.work_done()
+
+
+    def receive_messages(self, queue):
+        """
+        Moves every message that has arrived from the distributor to the queue without blocking, so revocations
+        are seen before the items they revoke are started.
+        """
+        while self.worker.poll(0):
+            msg = self.recv_from_distributor()
+            data, tt, msgtype = messages.get(msg)
+            assert tt == self.task_type
+
+            if msgtype == messages.MESSAGE_TYPE_REVOKE:
+                self.revoke(queue, data)
+            else:
+                queue.append((messages.item_ids(data, msgtype), (data, msgtype)))
 
 
     def run(self):
-        self.send_init_msg()
-        self.main_loop()
+        self.start_heartbeat()
+        if self.send_init_msg():
+            self.main_loop()
+        self.stop_heartbeat()
 
 
     @abstractmethod
@@ -298,6 +1051,115 @@ class SingleThreadedWorker(Worker):
 
 
 
+class GreenWorker(Worker):
+    """
+    A worker for I/O bound handlers that processes up to max_concurrency items at once on greenlets, instead of
+    holding an OS thread per item. Requires gevent.
+
+    handle_execution() runs on a greenlet of its own for each item, so it must only block on cooperative I/O:
+    sockets created from zmq.green, or libraries patched by gevent.monkey.patch_all(). Items are pulled from
+    the distributor with a credit window of max_concurrency, so new items arrive as soon as a greenlet frees up.
+
+    Like other gevent programs, run it on the main thread of its process.
+    """
+    # the number of items handled at the same time
+    max_concurrency = 100
+
+    # defaults to max_concurrency
+    credit_window = None
+
+    context_class = zmq_green.Context if gevent else None
+
+    def __init__(self, *args, **kwargs):
+        if gevent is None:
+            raise ImportError('GreenWorker requires gevent')
+        if self.max_concurrency < 1:
+            raise ValueError('max_concurrency must be a positive integer')
+        if self.credit_window is None:
+            self.credit_window = self.max_concurrency
+
+        super(GreenWorker, self).__init__(*args, **kwargs)
+        self.heartbeat_stop = gevent.event.Event()
+        self.pool = gevent.pool.Pool(self.max_concurrency)
+
+
+    def spawn(self, target, *args):
+        gevent.spawn(target, *args)
+
+
+    def process_message(self, data, msgtype):
+        if msgtype == messages.MESSAGE_TYPE_BATCH:
+            self.logger.debug('Worker invoking handle_execution_batch on task type %s with %d items', self.task_type, len(data))
+            self.results.add(msgtype, self.execute_batch(data))
+        else:
+            data = data or {}
+            self.logger.debug('Worker invoking handle_execution on task type %s with data: %s', self.task_type, data)
+            self.results.add(msgtype, self.execute(data))
+        self.work_done()
+
+
+    def flush_loop(self):
+        """
+        Sends buffered results as they fall due, as results are added by greenlets while the main loop waits
+        """
+        while True:
+            gevent.sleep(self.result_flush_interval)
+            self.results.flush_if_due()
+
+
+    def main_loop(self):
+        self.logger.info('Green worker running at address %s, ID: %s, max concurrency: %d', self.endpoint, self.worker_id,
+                         self.max_concurrency)
+
+        flusher = gevent.spawn(self.flush_loop) if self.result_batch_size else None
+
+        self.request_work(self.credit_window)
+        while True:
+            msg = self.recv_from_distributor()
+            data, tt, msgtype = messages.get(msg)
+            assert tt == self.task_type
+
+            if msgtype == messages.MESSAGE_TYPE_REVOKE:
+                # items are started as soon as they arrive, so none are left to revoke
+                self.revoke(deque(), data)
+                continue
+
+            if msgtype == messages.MESSAGE_TYPE_END:
+                self.logger.info('Worker received END message. Waiting on %d items', len(self.pool))
+                self.pool.join()
+                if flusher:
+                    flusher.kill()
+                self.results.flush()
+                break
+
+            if self.credit_mode:
+                # blocks while max_concurrency items are being handled
+                self.pool.spawn(self.process_message, data, msgtype)
+            else:
+                self.process_message(data, msgtype)
+
+
+    def run(self):
+        self.start_heartbeat()
+        if self.send_init_msg():
+            self.main_loop()
+        self.stop_heartbeat()
+
+
+    @abstractmethod
+    def handle_execution(self, data, *args, **kwargs):
+        """
+        Invoked on a greenlet of its own whenever a task is received from the distributor.
+
+        :param dict data: Data provided as a dictionary from the distributor
+        :param args: A list of additional positional arguments
+        :param kwargs: A list of additional keyword arguments
+        :return: A dictionary of data to be passed to the collector
+        """
+        return {}
+
+
+
 class MetaDataWorker(object):
     """
     Transmits meta information to the distributor for dynamic configuration at runtime.